@@ -0,0 +1,265 @@
+from __future__ import print_function, absolute_import
+import time
+import numpy as np
+
+import torch
+from torch.nn import functional as F
+
+from distance import pairwise_distance, distance_blocks
+
+"""Nearest-neighbour search backends for ranking a gallery"""
+
+__all__ = ['backends', 'create', 'kmeans', 'ExactSearch', 'IVFSearch', 'FaissIVFSearch', 'recall_at_k']
+
+
+def _as_tensor(features):
+    return torch.as_tensor(np.asarray(features, dtype=np.float32))
+
+
+def _merge_topk(best_dist, best_rows, dist, rows, k):
+    """Keep the k smallest of two (num_query, *) candidate sets, nearest first."""
+    dist = torch.cat((best_dist, dist), 1)
+    rows = torch.cat((best_rows, rows), 1)
+    best_dist, top = torch.topk(dist, min(k, dist.size(1)), dim=1, largest=False, sorted=True)
+    return best_dist, torch.gather(rows, 1, top)
+
+
+def kmeans(x, num_clusters, iters=20, seed=0, chunk_size=65536):
+    """Lloyd's k-means on the rows of ``x``.
+
+    Centroids start from randomly chosen rows; a cluster that loses all its
+    members is restarted from a random row.
+
+    Args:
+        x (torch.Tensor): (n, feat_dim) float32 points.
+        num_clusters (int): number of centroids, capped by n.
+        iters (int): Lloyd iterations.
+        seed (int): seed of the initialization.
+        chunk_size (int): rows assigned at a time, bounds the n-by-num_clusters distances.
+
+    Returns:
+        centroids (num_clusters, feat_dim) and the assignment (n,) of every row.
+    """
+    n = x.size(0)
+    num_clusters = min(num_clusters, n)
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(n, generator=generator)[:num_clusters]].clone()
+    assign = torch.zeros(n, dtype=torch.long)
+    for iteration in range(iters + 1):
+        for start in range(0, n, chunk_size):
+            dist = pairwise_distance(x[start:start + chunk_size], centroids, metric='sqeuclidean')
+            assign[start:start + chunk_size] = dist.argmin(1)
+        if iteration == iters:
+            break
+        counts = torch.bincount(assign, minlength=num_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        if empty.any():
+            centroids[empty] = x[torch.randint(n, (int(empty.sum()),), generator=generator)]
+    return centroids, assign
+
+
+class ExactSearch(object):
+    """Brute-force k nearest neighbours, the reference for the approximate backends.
+
+    Args:
+        block_size (int): query rows per distance tile.
+    """
+    def __init__(self, block_size=1024):
+        self.block_size = block_size
+        self.features = None
+
+    def build(self, features, metric='sqeuclidean'):
+        self.features = _as_tensor(features)
+        self.metric = metric
+        return self
+
+    def search(self, queries, k):
+        """k nearest gallery rows of every query.
+
+        Returns:
+            distances (num_query, k) float32 and rows (num_query, k) int64 numpy
+            arrays, nearest first. Rows are -1 where fewer than k candidates exist.
+        """
+        queries = _as_tensor(queries)
+        k = min(k, self.features.size(0))
+        dist, rows = [], []
+        for start, end, distmat in distance_blocks(queries, self.features, self.block_size, self.metric):
+            block_dist, block_rows = torch.topk(torch.from_numpy(distmat), k, dim=1, largest=False, sorted=True)
+            dist.append(block_dist)
+            rows.append(block_rows)
+        return torch.cat(dist).numpy(), torch.cat(rows).numpy()
+
+
+class IVFSearch(object):
+    """Inverted-file search over a k-means coarse quantizer.
+
+    build() clusters the gallery into ``nlist`` lists. A query is compared
+    only with the members of its ``nprobe`` nearest lists, so it visits about
+    nprobe / nlist of the gallery. Candidate distances are exact, so results
+    differ from ExactSearch only by neighbours that fall in unprobed lists.
+    Raising nprobe trades speed for recall; nprobe == nlist is exact.
+
+    Args:
+        nlist (int): number of lists (k-means centroids), about sqrt(gallery size) works well.
+        nprobe (int): lists visited per query.
+        iters (int): k-means iterations.
+        max_train (int): rows k-means is fitted on, a random subset of larger galleries.
+        seed (int): seed of the k-means initialization and training subset.
+    """
+    def __init__(self, nlist=100, nprobe=8, iters=20, max_train=65536, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iters = iters
+        self.max_train = max_train
+        self.seed = seed
+
+    def build(self, features, metric='sqeuclidean'):
+        x = _as_tensor(features)
+        self.metric = metric
+        if metric == 'cosine':
+            # on unit vectors the squared euclidean distance is 2 * cosine distance
+            x = F.normalize(x, p=2, dim=1)
+        train = x
+        if x.size(0) > self.max_train:
+            generator = torch.Generator().manual_seed(self.seed)
+            train = x[torch.randperm(x.size(0), generator=generator)[:self.max_train]]
+        self.centroids, _ = kmeans(train, self.nlist, self.iters, self.seed)
+        assign = torch.cat([pairwise_distance(x[start:start + 65536], self.centroids, metric='sqeuclidean').argmin(1)
+                            for start in range(0, x.size(0), 65536)])
+        # members of each list are stored contiguously
+        self.rows = torch.argsort(assign, stable=True)
+        self.members = x[self.rows]
+        counts = torch.bincount(assign, minlength=self.centroids.size(0))
+        self.offsets = torch.cat((torch.zeros(1, dtype=torch.long), counts.cumsum(0))).tolist()
+        self.size = x.size(0)
+        return self
+
+    def search(self, queries, k):
+        """Same outputs as ExactSearch.search."""
+        queries = _as_tensor(queries)
+        if self.metric == 'cosine':
+            queries = F.normalize(queries, p=2, dim=1)
+        m, k = queries.size(0), min(k, self.size)
+        nprobe = min(self.nprobe, self.centroids.size(0))
+        probe = torch.topk(pairwise_distance(queries, self.centroids, metric='sqeuclidean'),
+                           nprobe, dim=1, largest=False)[1]
+        best_dist = torch.full((m, k), float('inf'))
+        best_rows = torch.full((m, k), -1, dtype=torch.long)
+        # list by list: every list is one matrix product with the queries that probe it
+        probed = torch.zeros(m, self.centroids.size(0), dtype=torch.bool)
+        probed[torch.arange(m).unsqueeze(1), probe] = True
+        for list_id in range(self.centroids.size(0)):
+            begin, end = self.offsets[list_id], self.offsets[list_id + 1]
+            query_ids = probed[:, list_id].nonzero().squeeze(1)
+            if begin == end or query_ids.numel() == 0:
+                continue
+            dist = pairwise_distance(queries[query_ids], self.members[begin:end], metric=self.metric)
+            rows = self.rows[begin:end].unsqueeze(0).expand(query_ids.numel(), -1)
+            best_dist[query_ids], best_rows[query_ids] = _merge_topk(
+                best_dist[query_ids], best_rows[query_ids], dist, rows, k)
+        return best_dist.numpy(), best_rows.numpy()
+
+
+class FaissIVFSearch(object):
+    """IVF search through faiss (IndexIVFFlat), which must be installed separately.
+
+    Args:
+        nlist (int), nprobe (int): see IVFSearch.
+    """
+    def __init__(self, nlist=100, nprobe=8):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("The faiss-ivf backend needs faiss, e.g. `pip install faiss-cpu`")
+        self.faiss = faiss
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+    def build(self, features, metric='sqeuclidean'):
+        x = np.ascontiguousarray(features, dtype=np.float32)
+        self.metric = metric
+        if metric == 'cosine':
+            x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+            quantizer, faiss_metric = self.faiss.IndexFlatIP(x.shape[1]), self.faiss.METRIC_INNER_PRODUCT
+        else:
+            quantizer, faiss_metric = self.faiss.IndexFlatL2(x.shape[1]), self.faiss.METRIC_L2
+        self.quantizer = quantizer  # the index does not own it
+        self.index = self.faiss.IndexIVFFlat(quantizer, x.shape[1], min(self.nlist, x.shape[0]), faiss_metric)
+        self.index.train(x)
+        self.index.add(x)
+        self.index.nprobe = self.nprobe
+        return self
+
+    def search(self, queries, k):
+        """Same outputs as ExactSearch.search."""
+        q = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.metric == 'cosine':
+            q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        dist, rows = self.index.search(q, min(k, self.index.ntotal))
+        dist = dist.astype(np.float32)
+        if self.metric == 'cosine':
+            dist = 1 - dist
+        elif self.metric == 'euclidean':
+            dist = np.sqrt(np.maximum(dist, 0))
+        dist[rows < 0] = np.inf
+        return dist, rows.astype(np.int64)
+
+
+backends = ['exact', 'ivf', 'faiss-ivf']
+
+
+def create(name, nlist=100, nprobe=8, block_size=1024, seed=0):
+    """Search backend by name, one of ``backends``."""
+    if name == 'exact':
+        return ExactSearch(block_size)
+    elif name == 'ivf':
+        return IVFSearch(nlist, nprobe, seed=seed)
+    elif name == 'faiss-ivf':
+        return FaissIVFSearch(nlist, nprobe)
+    raise KeyError("Unknown search backend: {}. Expected one of {}".format(name, backends))
+
+
+def recall_at_k(rows, exact_rows):
+    """Mean fraction of the exact k nearest neighbours that a backend returned.
+
+    Args:
+        rows (numpy.ndarray): (num_query, k) rows returned by the backend under test.
+        exact_rows (numpy.ndarray): (num_query, k) rows returned by ExactSearch.
+    """
+    found = 0
+    for start in range(0, exact_rows.shape[0], 1024):
+        a, b = rows[start:start + 1024], exact_rows[start:start + 1024]
+        found += (a[:, :, None] == b[:, None, :]).any(1).sum()
+    return found / float(max(exact_rows.size, 1))
+
+
+if __name__ == '__main__':
+    # recall/latency trade-off on clustered synthetic features
+    rng = np.random.RandomState(0)
+    num_gallery, num_query, dim, k = 100000, 1000, 256, 10
+    modes = rng.randn(2000, dim).astype(np.float32)
+    gallery = modes[rng.randint(2000, size=num_gallery)] + 0.5 * rng.randn(num_gallery, dim).astype(np.float32)
+    queries = modes[rng.randint(2000, size=num_query)] + 0.5 * rng.randn(num_query, dim).astype(np.float32)
+
+    exact = ExactSearch().build(gallery)
+    start_time = time.time()
+    _, exact_rows = exact.search(queries, k)
+    exact_ms = (time.time() - start_time) / num_query * 1000
+    print("{} queries, {} gallery, dim {}: exact {:.3f} ms/query".format(num_query, num_gallery, dim, exact_ms))
+    for name in ['ivf', 'faiss-ivf']:
+        for nprobe in [1, 4, 16]:
+            try:
+                backend = create(name, nlist=316, nprobe=nprobe)
+            except ImportError as e:
+                print("  {}: skipped, {}".format(name, e))
+                break
+            start_time = time.time()
+            backend.build(gallery)
+            build_s = time.time() - start_time
+            start_time = time.time()
+            _, rows = backend.search(queries, k)
+            ms = (time.time() - start_time) / num_query * 1000
+            print("  {} nprobe {:<2}: build {:.1f} s, {:.3f} ms/query, recall@{} {:.3f}".format(
+                name, nprobe, build_s, ms, k, recall_at_k(rows, exact_rows)))
@@ -0,0 +1,171 @@
+from __future__ import print_function, absolute_import
+import time
+
+import torch
+from torch.nn import functional as F
+
+"""Pairwise distance kernels shared by the losses and evaluation"""
+
+__all__ = ['metrics', 'pairwise_distance', 'paired_distance', 'distance_blocks']
+
+metrics = ['euclidean', 'sqeuclidean', 'cosine']
+
+
+def _check(metric, dtype):
+    assert metric in metrics, "Error: metric must be one of {}, but got {}".format(metrics, metric)
+    assert dtype in (None, torch.float32, torch.float16, torch.bfloat16), \
+        "Error: dtype must be None, float32, float16 or bfloat16, but got {}".format(dtype)
+
+
+def _mm(a, b, out_dtype):
+    """a @ b of low-precision a and b, returned as out_dtype without rounding the product.
+
+    On CUDA the GEMM returns its float32 accumulator (torch.mm's out_dtype).
+    Elsewhere, or with a torch without out_dtype, the rounded inputs are cast
+    back and multiplied in out_dtype, which gives the same result at fp32 speed.
+    """
+    if a.is_cuda:
+        try:
+            return torch.mm(a, b, out_dtype=out_dtype)
+        except (TypeError, RuntimeError):
+            pass  # torch without mm(out_dtype=...)
+    return torch.mm(a.to(out_dtype), b.to(out_dtype))
+
+
+def pairwise_distance(x, y=None, metric='euclidean', dtype=None, chunk_size=None, eps=1e-12):
+    """Distances between every row of ``x`` and every row of ``y``.
+
+    Euclidean distances use ||x||^2 + ||y||^2 - 2 x.y: the norms are added
+    into a preallocated output and the product is accumulated into it in place.
+    With ``dtype`` float16/bfloat16 the inputs of the matrix product are
+    rounded to that precision and the product is accumulated and returned in
+    float32 (see _mm), so only input rounding is lost; norms and the result
+    stay float32. The speedup needs a GPU; on CPU the product runs in float32.
+
+    Args:
+        x (torch.Tensor): features with shape (m, feat_dim).
+        y (torch.Tensor): features with shape (n, feat_dim), defaults to x.
+        metric (str): 'euclidean', 'sqeuclidean' or 'cosine' (1 - cosine similarity).
+        dtype (torch.dtype): compute precision of the product, None keeps the input's.
+        chunk_size (int): rows of x processed at a time, bounds the low-precision copies.
+        eps (float): lower clamp before the square root, keeps the gradient finite.
+
+    Returns:
+        (m, n) distance matrix in the input's (or float32 for low-precision) dtype.
+    """
+    _check(metric, dtype)
+    self_distance = y is None
+    if self_distance:
+        y = x
+    low_precision = dtype is not None and dtype != x.dtype
+    out_dtype = torch.float32 if low_precision else x.dtype
+    m = x.size(0)
+    chunk_size = chunk_size or m
+
+    if metric == 'cosine':
+        x = F.normalize(x, p=2, dim=1)
+        y = x if self_distance else F.normalize(y, p=2, dim=1)
+    else:
+        # with low precision the norms are taken of the same rounded inputs as the product
+        rounded = (lambda t: t.to(dtype).to(out_dtype)) if low_precision else (lambda t: t)
+        x_sq = torch.pow(rounded(x), 2).sum(dim=1)
+        y_sq = x_sq if self_distance else torch.pow(rounded(y), 2).sum(dim=1)
+    y_t = (y.to(dtype) if low_precision else y).t()
+
+    blocks = []
+    for start in range(0, m, chunk_size):
+        q = x[start:start + chunk_size]
+        q = q.to(dtype) if low_precision else q
+        if metric == 'cosine':
+            block = _mm(q, y_t, out_dtype).neg_().add_(1)
+        elif low_precision:
+            block = _mm(q, y_t, out_dtype).mul_(-2)
+            block += x_sq[start:start + chunk_size].unsqueeze(1)
+            block += y_sq.unsqueeze(0)
+        else:
+            block = x_sq[start:start + chunk_size].unsqueeze(1) + y_sq.unsqueeze(0)
+            block.addmm_(q, y_t, beta=1, alpha=-2)
+        blocks.append(block)
+    dist = blocks[0] if len(blocks) == 1 else torch.cat(blocks)
+
+    if metric == 'euclidean':
+        dist = dist.clamp_(min=eps).sqrt_()  # for numerical stability
+    elif metric == 'sqeuclidean':
+        dist = dist.clamp_(min=0)
+    return dist
+
+
+def paired_distance(x, y, metric='euclidean', eps=1e-12):
+    """Distance between each row of ``x`` and the same row of ``y``.
+
+    Args:
+        x (torch.Tensor), y (torch.Tensor): features with shape (n, feat_dim).
+        metric (str): 'euclidean', 'sqeuclidean' or 'cosine'.
+
+    Returns:
+        (n,) distances.
+    """
+    _check(metric, None)
+    if metric == 'cosine':
+        return 1 - F.cosine_similarity(x, y, dim=1)
+    dist = (x - y).pow(2).sum(dim=1)
+    if metric == 'euclidean':
+        dist = dist.clamp(min=eps).sqrt()
+    return dist
+
+
+def distance_blocks(qf, gf, block_size=1024, metric='sqeuclidean', dtype=None):
+    """Yield distances between ``qf`` and ``gf`` row block by row block.
+
+    Only one block_size-by-num_gallery tile is alive at a time, so memory does
+    not grow with the number of queries.
+
+    Args:
+        qf (torch.Tensor): query features with shape (num_query, feat_dim).
+        gf (torch.Tensor): gallery features with shape (num_gallery, feat_dim).
+        block_size (int): number of query rows per tile.
+        metric (str), dtype (torch.dtype): see pairwise_distance.
+
+    Yields:
+        (start, end, distmat) where distmat is a numpy array holding rows
+        start:end of the full distance matrix.
+    """
+    m = qf.size(0)
+    for start in range(0, m, block_size):
+        end = min(start + block_size, m)
+        distmat = pairwise_distance(qf[start:end], gf, metric=metric, dtype=dtype)
+        yield start, end, distmat.numpy()
+
+
+if __name__ == '__main__':
+    # micro-benchmark against the expand/addmm_ idiom previously inlined in the losses and test()
+    def legacy(x, y):
+        m, n = x.size(0), y.size(0)
+        distmat = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(m, n) + \
+                  torch.pow(y, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+        distmat.addmm_(x, y.t(), beta=1, alpha=-2)
+        return distmat
+
+    def bench(fn, repeat):
+        fn()
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(repeat):
+            fn()
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        return (time.time() - start_time) / repeat * 1000
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for m, n, d, repeat in [(32, 32, 2048, 200), (2000, 10000, 1024, 3)]:
+        x, y = torch.randn(m, d, device=device), torch.randn(n, d, device=device)
+        ref = legacy(x, y)
+        print("{}x{}, dim {} on {}".format(m, n, d, device))
+        print("  legacy expand/addmm_: {:.3f} ms".format(bench(lambda: legacy(x, y), repeat)))
+        for dtype in [None, torch.float16, torch.bfloat16]:
+            if dtype == torch.float16 and device == 'cpu':
+                continue
+            err = (pairwise_distance(x, y, 'sqeuclidean', dtype) - ref).abs().max().item()
+            ms = bench(lambda: pairwise_distance(x, y, 'sqeuclidean', dtype), repeat)
+            print("  sqeuclidean {}: {:.3f} ms, max abs err {:.2e}".format(dtype or x.dtype, ms, err))
+        ms = bench(lambda: pairwise_distance(x, y, 'cosine'), repeat)
+        print("  cosine: {:.3f} ms".format(ms))
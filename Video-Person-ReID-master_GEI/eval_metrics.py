@@ -1,57 +1,228 @@
 from __future__ import print_function, absolute_import
 import numpy as np
 import copy
+import torch
+from collections import Counter
 
-def evaluate(distmat, q_pids, g_pids, q_camids, g_camids,q_seq_types, g_seq_types, max_rank=50):
-    num_q, num_g = distmat.shape
-    if num_g < max_rank:
-        max_rank = num_g
-        print("Note: number of gallery samples is quite small, got {}".format(num_g))
+
+def _evaluate_rows(distmat, q_pids, g_pids, q_camids, g_camids, q_seq_types, g_seq_types, max_rank):
+    """Compute CMC hits and AP for a block of query rows at once.
+
+    Gallery samples sharing pid, camid and seq_type with the query are junk and
+    are skipped when ranking, exactly as the per-query reference loop did.
+
+    Returns:
+        cmc (np.ndarray): int32 matrix (num_valid, max_rank) of cumulative hits.
+        AP (np.ndarray): float64 vector (num_valid,) of average precisions.
+    """
     indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+    sorted_pids = g_pids[indices]
+    matches = sorted_pids == q_pids[:, np.newaxis]
+    remove = matches & (g_camids[indices] == q_camids[:, np.newaxis]) & \
+             (g_seq_types[indices] == q_seq_types[:, np.newaxis])
+    keep = np.invert(remove)
+    del indices, sorted_pids
+
+    # binary matrix, positions with value 1 are correct matches among kept samples
+    hits = matches & keep
+    num_rel = hits.sum(1)
+    valid = num_rel > 0  # false when query identity does not appear in gallery
+    hits, keep, num_rel = hits[valid], keep[valid], num_rel[valid]
+
+    # rank of every gallery sample once junk samples are dropped (0-based)
+    kept_rank = keep.cumsum(1) - 1
+    first_hit = kept_rank[np.arange(hits.shape[0]), hits.argmax(1)]
+    cmc = (np.arange(max_rank)[np.newaxis, :] >= first_hit[:, np.newaxis]).astype(np.int32)
+
+    # compute average precision
+    # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+    precision = hits.cumsum(1) / (np.maximum(kept_rank, 0) + 1.)
+    AP = (precision * hits).sum(1) / num_rel
+
+    return cmc, AP
+
+
+def _evaluate_rows_partial(distmat, q_pids, g_pids, q_camids, g_camids, q_seq_types, g_seq_types, max_rank):
+    """Same outputs as _evaluate_rows without argsorting whole gallery rows.
+
+    Only the rank of every positive among the kept samples is needed, for AP
+    and (through the nearest positive) for CMC. Kept distances are sorted as
+    values in one working copy, which is much cheaper than an argsort plus
+    label gathers, and the few positives of a row are binary-searched into
+    it: the samples closer than a positive minus the positives closer than it
+    are the negatives ranked before it. A negative at exactly the same
+    distance as a positive is ranked behind it.
+    """
+    num_g = distmat.shape[1]
+    positive = g_pids[np.newaxis, :] == q_pids[:, np.newaxis]
+    remove = positive & (g_camids[np.newaxis, :] == q_camids[:, np.newaxis]) & \
+             (g_seq_types[np.newaxis, :] == q_seq_types[:, np.newaxis])
+    positive &= np.invert(remove)
+
+    num_rel = positive.sum(1)
+    valid = num_rel > 0  # false when query identity does not appear in gallery
+    if not valid.any():
+        return np.zeros((0, max_rank), dtype=np.int32), np.zeros(0)
+    if not valid.all():
+        distmat, positive, remove, num_rel = distmat[valid], positive[valid], remove[valid], num_rel[valid]
+    num_rows = distmat.shape[0]
+
+    # the only dense copy: kept distances, junk samples pushed to the end
+    kept_dist = np.array(distmat)
+    kept_dist[remove] = np.inf
+    del remove
+
+    # distances of the positives, gathered sparsely, sorted and padded with inf
+    max_rel = int(num_rel.max())
+    flat = np.flatnonzero(positive)
+    pos_rows = flat // num_g
+    starts = np.concatenate(([0], num_rel.cumsum()[:-1]))
+    pos_dist = np.full((num_rows, max_rel), np.inf, dtype=kept_dist.dtype)
+    pos_dist[pos_rows, np.arange(flat.size) - starts[pos_rows]] = kept_dist.ravel()[flat]
+    pos_dist.sort(axis=1)
+    del positive, flat, pos_rows
+
+    # negatives_before[r, k]: kept negatives strictly closer than the k-th positive
+    kept_dist.sort(axis=1)
+    pos_dist = torch.from_numpy(pos_dist)
+    closer = torch.searchsorted(torch.from_numpy(kept_dist), pos_dist)
+    closer_positives = torch.searchsorted(pos_dist, pos_dist)
+    negatives_before = (closer - closer_positives).numpy()
+
+    # the nearest positive is preceded by negatives_before[:, 0] kept samples
+    cmc = (np.arange(max_rank)[np.newaxis, :] >= negatives_before[:, :1]).astype(np.int32)
+
+    # compute average precision
+    # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+    order = np.arange(max_rel)[np.newaxis, :]
+    precision = (order + 1.) / (order + negatives_before + 1.)
+    precision[order >= num_rel[:, np.newaxis]] = 0
+    AP = precision.sum(1) / num_rel
+
+    return cmc, AP
+
+
+def _evaluate_topk(rows, num_rel, q_pids, g_pids, q_camids, g_camids, q_seq_types, g_seq_types, max_rank):
+    """CMC hits and AP from ranked lists of retrieved gallery samples only.
+
+    ``rows`` holds the retrieved gallery indices of every query, nearest first
+    (-1 where nothing was retrieved). Junk samples are dropped from the lists as
+    in _evaluate_rows. ``num_rel`` counts every positive in the gallery, so a
+    positive that was not retrieved is a miss: AP is truncated at the list
+    length and CMC never reaches a match below it. With complete lists the
+    results equal _evaluate_rows'.
+    """
+    retrieved = rows >= 0
+    rows = np.where(retrieved, rows, 0)
+    matches = (g_pids[rows] == q_pids[:, np.newaxis]) & retrieved
+    remove = matches & (g_camids[rows] == q_camids[:, np.newaxis]) & \
+             (g_seq_types[rows] == q_seq_types[:, np.newaxis])
+    keep = retrieved & np.invert(remove)
+    hits = matches & keep
+    valid = num_rel > 0  # false when query identity does not appear in gallery
+    hits, keep, num_rel = hits[valid], keep[valid], num_rel[valid]
+
+    kept_rank = keep.cumsum(1) - 1
+    first_hit = np.where(hits.any(1), kept_rank[np.arange(hits.shape[0]), hits.argmax(1)], max_rank)
+    cmc = (np.arange(max_rank)[np.newaxis, :] >= first_hit[:, np.newaxis]).astype(np.int32)
+
+    precision = hits.cumsum(1) / (np.maximum(kept_rank, 0) + 1.)
+    AP = (precision * hits).sum(1) / num_rel
+
+    return cmc, AP
+
+
+class RankAccumulator(object):
+    """Accumulates CMC hits and AP over blocks of query rows.
+
+    Lets callers feed query-by-gallery distance tiles one at a time so the
+    full distance matrix never has to exist.
+
+    Args:
+        g_pids, g_camids, g_seq_types: gallery labels.
+        max_rank (int): length of the CMC curve.
+        partial (bool): rank positives by binary search into sorted distances, see _evaluate_rows_partial.
+    """
+    def __init__(self, g_pids, g_camids, g_seq_types, max_rank=50, partial=False):
+        num_g = len(g_pids)
+        if num_g < max_rank:
+            max_rank = num_g
+            print("Note: number of gallery samples is quite small, got {}".format(num_g))
+        self.g_pids = np.asarray(g_pids)
+        self.g_camids = np.asarray(g_camids)
+        # seq_types are strings such as 'nm-01'; compare integer codes instead
+        self.seq_names, self.g_seq_types = np.unique(np.asarray(g_seq_types), return_inverse=True)
+        self.max_rank = max_rank
+        self.evaluate_rows = _evaluate_rows_partial if partial else _evaluate_rows
+        self.cmc_sum = np.zeros(max_rank, dtype=np.int64)
+        self.all_AP = []
+        self.num_valid_q = 0.
+
+    def _seq_codes(self, seq_types):
+        seq_types = np.asarray(seq_types)
+        codes = np.searchsorted(self.seq_names, seq_types)
+        codes = np.minimum(codes, len(self.seq_names) - 1)
+        # a seq_type the gallery never uses can not mark any gallery sample as junk
+        codes[self.seq_names[codes] != seq_types] = -1
+        return codes
 
-    # compute cmc curve for each query
-    all_cmc = []
-    all_AP = []
-    num_valid_q = 0.
-    for q_idx in range(num_q):
-        # get query pid and camid
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-        q_seq_type =q_seq_types[q_idx]
+    def update(self, distmat, q_pids, q_camids, q_seq_types):
+        cmc, AP = self.evaluate_rows(distmat, np.asarray(q_pids), self.g_pids,
+                                     np.asarray(q_camids), self.g_camids,
+                                     self._seq_codes(q_seq_types), self.g_seq_types, self.max_rank)
+        self.cmc_sum += cmc.sum(0)
+        self.all_AP.append(AP)
+        self.num_valid_q += cmc.shape[0]
 
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)&(g_seq_types[order] == q_seq_type)
-        keep = np.invert(remove)
+    def _num_relevant(self, q_pids, q_camids, q_seq_codes):
+        """Positives of every query in the whole gallery: same pid, minus the junk samples."""
+        if not hasattr(self, '_pid_counts'):
+            self._pid_counts = Counter(self.g_pids.tolist())
+            self._junk_counts = Counter(zip(self.g_pids.tolist(), self.g_camids.tolist(),
+                                            self.g_seq_types.tolist()))
+        return np.array([self._pid_counts[pid] - self._junk_counts[(pid, camid, seq)]
+                         for pid, camid, seq in zip(q_pids.tolist(), q_camids.tolist(), q_seq_codes.tolist())],
+                        dtype=np.int64)
 
-        # compute cmc curve
-        orig_cmc = matches[q_idx][keep] # binary vector, positions with value 1 are correct matches
-        if not np.any(orig_cmc):
-            # this condition is true when query identity does not appear in gallery
-            continue
+    def update_topk(self, rows, q_pids, q_camids, q_seq_types):
+        """update() from ranked lists of retrieved gallery indices instead of a distance tile.
 
-        cmc = orig_cmc.cumsum()
-        cmc[cmc > 1] = 1
+        Args:
+            rows (numpy.ndarray): (num_query, k) gallery indices, nearest first, -1 for none;
+                e.g. from an ann search backend.
+        """
+        q_pids, q_camids = np.asarray(q_pids), np.asarray(q_camids)
+        q_seq_codes = self._seq_codes(q_seq_types)
+        num_rel = self._num_relevant(q_pids, q_camids, q_seq_codes)
+        cmc, AP = _evaluate_topk(np.asarray(rows), num_rel, q_pids, self.g_pids, q_camids, self.g_camids,
+                                 q_seq_codes, self.g_seq_types, self.max_rank)
+        self.cmc_sum += cmc.sum(0)
+        self.all_AP.append(AP)
+        self.num_valid_q += cmc.shape[0]
 
-        all_cmc.append(cmc[:max_rank])
-        num_valid_q += 1.
+    def result(self):
+        assert self.num_valid_q > 0, "Error: all query identities do not appear in gallery"
 
-        # compute average precision
-        # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = orig_cmc.sum()
-        tmp_cmc = orig_cmc.cumsum()
-        tmp_cmc = [x / (i+1.) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * orig_cmc
-        AP = tmp_cmc.sum() / num_rel
-        all_AP.append(AP)
+        all_cmc = self.cmc_sum.astype(np.float32) / self.num_valid_q
+        mAP = np.mean(np.concatenate(self.all_AP))
 
-    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+        return all_cmc, mAP
 
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
 
-    return all_cmc, mAP
+def evaluate(distmat, q_pids, g_pids, q_camids, g_camids,q_seq_types, g_seq_types, max_rank=50, chunk_size=1024,
+             partial=False):
+    """Evaluation with CASIA metric.
 
+    Queries are processed ``chunk_size`` rows at a time so that the sorted index
+    and match matrices never exceed chunk_size-by-num_gallery. With ``partial``
+    the argsort and label gathers are replaced by a value sort and a binary
+    search of the positives (see _evaluate_rows_partial), which is cheaper and
+    gives the same CMC and mAP up to ordering of tied distances.
+    """
+    num_q = distmat.shape[0]
+    accumulator = RankAccumulator(g_pids, g_camids, g_seq_types, max_rank=max_rank, partial=partial)
+    for start in range(0, num_q, chunk_size):
+        end = min(start + chunk_size, num_q)
+        accumulator.update(distmat[start:end], q_pids[start:end], q_camids[start:end], q_seq_types[start:end])
 
+    return accumulator.result()
@@ -0,0 +1,161 @@
+from __future__ import print_function, absolute_import
+import os
+import json
+import glob
+import hashlib
+import os.path as osp
+import numpy as np
+
+from utils import mkdir_if_missing
+
+"""On-disk store of extracted tracklet features"""
+
+__all__ = ['checkpoint_hash', 'FeatureStore', 'FrameFeatureStore']
+
+
+def checkpoint_hash(model):
+    """sha1 of a model's weights, independent of DataParallel wrapping."""
+    sha = hashlib.sha1()
+    state_dict = model.state_dict()
+    for key in sorted(state_dict.keys()):
+        sha.update(key.replace('module.', '', 1).encode('utf-8'))
+        sha.update(state_dict[key].detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class FeatureStore(object):
+    """Features of tracklets extracted by one checkpoint with one sampling config.
+
+    Entries live under ``root/<key>``, where key hashes the checkpoint weights
+    together with ``config`` (seq_len, image size, pooling, ...). Every call to
+    add() writes a new segment of memory-mapped .npy files holding features,
+    pids, camids, seq_types and tracklet ids, so previously stored rows are
+    never rewritten. Segments are loaded lazily with mmap_mode='r'.
+
+    Args:
+        root (str): directory that holds all stores.
+        model (nn.Module): model whose weights identify the checkpoint.
+        config (dict): json-serializable feature extraction settings.
+    """
+    arrays = ('features', 'pids', 'camids', 'seq_types', 'ids')
+
+    def __init__(self, root, model, config):
+        sha = hashlib.sha1(checkpoint_hash(model).encode('utf-8'))
+        sha.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+        self.store_dir = osp.join(root, sha.hexdigest())
+        self.config = config
+        self._segments = None
+        self._id2row = None
+
+    def _load(self):
+        if self._segments is not None:
+            return
+        self._segments, self._seg_numbers, self._id2row = [], [], {}
+        for seg_dir in sorted(glob.glob(osp.join(self.store_dir, 'seg-[0-9][0-9][0-9][0-9][0-9]'))):
+            segment = {name: np.load(osp.join(seg_dir, name + '.npy'), mmap_mode='r')
+                       for name in self.arrays}
+            seg_idx = len(self._segments)
+            self._segments.append(segment)
+            self._seg_numbers.append(int(osp.basename(seg_dir)[4:]))
+            for row, tracklet_id in enumerate(segment['ids']):
+                self._id2row[str(tracklet_id)] = (seg_idx, row)
+
+    def __len__(self):
+        self._load()
+        return len(self._id2row)
+
+    def missing(self, tracklet_ids):
+        """Positions in ``tracklet_ids`` that are not stored yet."""
+        self._load()
+        return [i for i, tracklet_id in enumerate(tracklet_ids) if tracklet_id not in self._id2row]
+
+    def get(self, tracklet_ids):
+        """Gather stored rows in the order of ``tracklet_ids``.
+
+        Returns:
+            features, pids, camids, seq_types as numpy arrays.
+        """
+        self._load()
+        locations = [self._id2row[tracklet_id] for tracklet_id in tracklet_ids]
+        assert len(locations) > 0, "Error: no tracklet requested"
+        outputs = []
+        for name in ('features', 'pids', 'camids', 'seq_types'):
+            outputs.append(np.stack([self._segments[seg][name][row] for seg, row in locations]))
+        return tuple(outputs)
+
+    def add(self, tracklet_ids, features, pids, camids, seq_types):
+        """Append a new segment; ids already stored are ignored."""
+        self._load()
+        new = [i for i, tracklet_id in enumerate(tracklet_ids) if tracklet_id not in self._id2row]
+        if not new:
+            return
+        arrays = {
+            'features': np.asarray(features, dtype=np.float32)[new],
+            'pids': np.asarray(pids, dtype=np.int64)[new],
+            'camids': np.asarray(camids, dtype=np.int64)[new],
+            'seq_types': np.asarray(seq_types, dtype=np.str_)[new],
+            'ids': np.asarray(tracklet_ids, dtype=np.str_)[new],
+        }
+        self._write_segment(arrays)
+
+    def _next_segment(self):
+        return self._seg_numbers[-1] + 1 if self._seg_numbers else 0
+
+    def _write_segment(self, arrays):
+        seg_dir = osp.join(self.store_dir, 'seg-{:05d}'.format(self._next_segment()))
+        tmp_dir = seg_dir + '.tmp'
+        mkdir_if_missing(tmp_dir)
+        for name, array in arrays.items():
+            np.save(osp.join(tmp_dir, name + '.npy'), array)
+        with open(osp.join(self.store_dir, 'config.json'), 'w') as f:
+            json.dump(self.config, f, indent=4, sort_keys=True)
+        os.rename(tmp_dir, seg_dir)  # a segment becomes visible only once complete
+        self._segments = None
+        print("Stored {} tracklet features in {}".format(len(arrays['ids']), self.store_dir))
+
+
+class FrameFeatureStore(FeatureStore):
+    """Per-frame features of tracklets, one variable-length block per tracklet.
+
+    Same layout as FeatureStore plus an ``offsets`` array per segment: the
+    frame features of the r-th tracklet of a segment are rows
+    offsets[r]:offsets[r + 1] of its features. ``config`` should hold only
+    what changes a frame's feature (arch, image size), so clip length and
+    pooling can be varied on top of the same store.
+    """
+    arrays = FeatureStore.arrays + ('offsets',)
+
+    def get(self, tracklet_ids):
+        """Gather stored tracklets in the order of ``tracklet_ids``.
+
+        Returns:
+            list of (num_frames, feat_dim) arrays, then pids, camids, seq_types as numpy arrays.
+        """
+        self._load()
+        locations = [self._id2row[tracklet_id] for tracklet_id in tracklet_ids]
+        assert len(locations) > 0, "Error: no tracklet requested"
+        frame_features = []
+        for seg, row in locations:
+            offsets = self._segments[seg]['offsets']
+            frame_features.append(self._segments[seg]['features'][offsets[row]:offsets[row + 1]])
+        outputs = [frame_features]
+        for name in ('pids', 'camids', 'seq_types'):
+            outputs.append(np.stack([self._segments[seg][name][row] for seg, row in locations]))
+        return tuple(outputs)
+
+    def add(self, tracklet_ids, frame_features, pids, camids, seq_types):
+        """Append a new segment from a list of (num_frames, feat_dim) arrays; ids already stored are ignored."""
+        self._load()
+        new = [i for i, tracklet_id in enumerate(tracklet_ids) if tracklet_id not in self._id2row]
+        if not new:
+            return
+        lengths = [len(frame_features[i]) for i in new]
+        arrays = {
+            'features': np.concatenate([np.asarray(frame_features[i], dtype=np.float32) for i in new]),
+            'offsets': np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+            'pids': np.asarray(pids, dtype=np.int64)[new],
+            'camids': np.asarray(camids, dtype=np.int64)[new],
+            'seq_types': np.asarray(seq_types, dtype=np.str_)[new],
+            'ids': np.asarray(tracklet_ids, dtype=np.str_)[new],
+        }
+        self._write_segment(arrays)
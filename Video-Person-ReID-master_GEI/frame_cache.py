@@ -0,0 +1,84 @@
+from __future__ import print_function, absolute_import
+import hashlib
+import multiprocessing as mp
+import numpy as np
+from PIL import Image
+
+import torch
+
+"""Shared-memory cache of decoded frames"""
+
+__all__ = ['FrameCache']
+
+
+class FrameCache(object):
+    """Size-bounded LRU cache of decoded, resized frames shared by DataLoader workers.
+
+    Frames are kept as uint8 (height, width, 3) slots of one tensor in shared
+    memory. The slot table (key hash and last-use stamp per slot) lives in
+    shared memory as well and is guarded by one lock, so a frame decoded by
+    one worker is a hit for every other worker. When all slots are taken the
+    least recently used one is overwritten. Create the cache in the main
+    process before the DataLoader starts its workers.
+
+    Args:
+        capacity (int): number of frames kept.
+        height (int), width (int): size frames are resized to before caching.
+        interpolation: PIL resampling filter.
+    """
+    def __init__(self, capacity, height, width, interpolation=Image.BILINEAR):
+        self.capacity = capacity
+        self.height = height
+        self.width = width
+        self.interpolation = interpolation
+        self.slots = torch.zeros(capacity, height, width, 3, dtype=torch.uint8).share_memory_()
+        self.keys = torch.full((capacity,), -1, dtype=torch.int64).share_memory_()
+        self.stamps = torch.zeros(capacity, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()  # clock, hits, misses
+        self.lock = mp.Lock()
+
+    @staticmethod
+    def _hash(img_path):
+        return int(hashlib.md5(img_path.encode('utf-8')).hexdigest()[:15], 16)
+
+    def get(self, img_path, load):
+        """Return the cached frame of ``img_path`` as a PIL image.
+
+        On a miss ``load(img_path)`` is called to decode it (it may return None
+        for an unreadable file, which is not cached), and the resized frame is
+        stored.
+        """
+        key = self._hash(img_path)
+        keys, stamps, counters = self.keys.numpy(), self.stamps.numpy(), self.counters.numpy()
+        with self.lock:
+            hit = np.flatnonzero(keys == key)
+            if hit.size > 0:
+                slot = hit[0]
+                counters[0] += 1
+                counters[1] += 1
+                stamps[slot] = counters[0]
+                return Image.fromarray(self.slots[slot].numpy().copy())
+            counters[2] += 1
+
+        img = load(img_path)
+        if img is None:
+            return None
+        img = img.resize((self.width, self.height), self.interpolation)
+        with self.lock:
+            if not np.any(keys == key):
+                slot = stamps.argmin()
+                counters[0] += 1
+                keys[slot] = key
+                stamps[slot] = counters[0]
+                self.slots[slot].numpy()[...] = np.asarray(img)
+        return img
+
+    def stats(self):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / float(max(hits + misses, 1)),
+                'size': int((self.keys >= 0).sum())}
+
+    def summary(self):
+        stats = self.stats()
+        return "{} hits, {} misses ({:.1%} hit rate), {}/{} frames cached".format(
+            stats['hits'], stats['misses'], stats['hit_rate'], stats['size'], self.capacity)
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import numpy as np
+
+"""Temporal sampling: which frames of a tracklet make up a clip"""
+
+__all__ = ['methods', 'clip_methods', 'frame_indices', 'consecutive', 'strided', 'segment', 'evenly', 'dense', 'all_frames']
+
+
+def _cycle(indices, seq_len):
+    """Repeat ``indices`` cyclically up to seq_len entries."""
+    return indices[np.arange(seq_len) % len(indices)]
+
+
+def consecutive(num, seq_len, rng=np.random, **kwargs):
+    """seq_len consecutive frames from a random start; short tracklets are cycled."""
+    begin = rng.randint(0, max(0, num - seq_len) + 1)
+    return _cycle(np.arange(begin, min(begin + seq_len, num)), seq_len)
+
+
+def strided(num, seq_len, rng=np.random, stride=2, **kwargs):
+    """Every stride-th frame from a random start.
+
+    The stride shrinks (down to 1) for tracklets too short to span seq_len
+    frames at the requested stride, which are then cycled like consecutive().
+    """
+    stride = max(1, min(stride, (num - 1) // max(seq_len - 1, 1)))
+    span = (seq_len - 1) * stride + 1
+    begin = rng.randint(0, max(0, num - span) + 1)
+    return _cycle(np.arange(begin, min(begin + span, num), stride), seq_len)
+
+
+def segment(num, seq_len, rng=np.random, **kwargs):
+    """One random frame from each of seq_len equal segments (TSN).
+
+    With ``rng=None`` the middle frame of every segment is taken instead.
+    """
+    bounds = np.arange(seq_len + 1) * num // seq_len
+    starts, lengths = bounds[:-1], np.maximum(bounds[1:] - bounds[:-1], 1)
+    offsets = lengths // 2 if rng is None else (rng.random_sample(seq_len) * lengths).astype(np.int64)
+    return starts + offsets
+
+
+def evenly(num, seq_len, **kwargs):
+    """seq_len frames evenly spread from the first to the last frame."""
+    return np.linspace(0, num - 1, seq_len).round().astype(np.int64)
+
+
+def dense(num, seq_len, **kwargs):
+    """All frames cut into consecutive clips of seq_len frames, shape (num_clips, seq_len).
+
+    The last clip is filled up by cycling its own frames.
+    """
+    num_clips = max(1, -(-num // seq_len))
+    indices = np.arange(num_clips * seq_len)
+    last = (num_clips - 1) * seq_len
+    overflow = indices >= num
+    indices[overflow] = last + (indices[overflow] - last) % (num - last)
+    return indices.reshape(num_clips, seq_len)
+
+
+def all_frames(num, seq_len, **kwargs):
+    """Every frame of the tracklet as one clip of num frames."""
+    return np.arange(num)
+
+
+methods = {
+    'random': consecutive,  # name kept from the original training setup
+    'consecutive': consecutive,
+    'strided': strided,
+    'segment': segment,
+    'evenly': evenly,
+    'dense': dense,
+    'all': all_frames,
+}
+
+# methods that return exactly one clip of seq_len frames, so tracklets batch with the default collate
+clip_methods = ['random', 'consecutive', 'strided', 'segment', 'evenly']
+
+
+def frame_indices(method, num, seq_len, rng=np.random, stride=2):
+    """Frame indices of a tracklet of num frames for sampling ``method``.
+
+    Returns:
+        (seq_len,) int array, (num,) for 'all', or (num_clips, seq_len) for 'dense'.
+    """
+    if method not in methods:
+        raise KeyError("Unknown sample method: {}. Expected one of {}".format(method, sorted(methods)))
+    return methods[method](num, seq_len, rng=rng, stride=stride)
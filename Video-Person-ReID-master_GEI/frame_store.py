@@ -0,0 +1,93 @@
+from __future__ import print_function, absolute_import
+import os
+import json
+import shutil
+import os.path as osp
+import numpy as np
+from PIL import Image
+
+from utils import mkdir_if_missing, tracklet_id
+
+"""Packed, memory-mapped frame store"""
+
+__all__ = ['pack_frames', 'FrameStore']
+
+
+def pack_frames(tracklets, store_dir, height, width, interpolation=Image.BILINEAR):
+    """Decode and resize all frames of ``tracklets`` once into a single uint8 array.
+
+    Writes to ``store_dir``:
+        frames.npy: (num_frames, height, width, 3) uint8, frames of a tracklet are contiguous.
+        offsets.npy: (num_tracklets + 1,) int64, frames of tracklet i are offsets[i]:offsets[i+1].
+        ids.npy: (num_tracklets,) tracklet ids, see utils.tracklet_id.
+        meta.json: frame size.
+    Tracklets that occur more than once (e.g. in both query and gallery) are stored once.
+    """
+    ids, unique = [], []
+    seen = set()
+    for tracklet in tracklets:
+        key = tracklet_id(tracklet[0])
+        if key not in seen:
+            seen.add(key)
+            ids.append(key)
+            unique.append(tracklet[0])
+    lengths = np.asarray([len(img_paths) for img_paths in unique], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    mkdir_if_missing(tmp_dir)
+    frames = np.lib.format.open_memmap(osp.join(tmp_dir, 'frames.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(int(offsets[-1]), height, width, 3))
+    print("Packing {} frames of {} tracklets into {}".format(offsets[-1], len(unique), store_dir))
+    for i, img_paths in enumerate(unique):
+        for j, img_path in enumerate(img_paths):
+            img = Image.open(img_path).convert('RGB')
+            frames[offsets[i] + j] = np.asarray(img.resize((width, height), interpolation))
+    frames.flush()
+    del frames
+    np.save(osp.join(tmp_dir, 'offsets.npy'), offsets)
+    np.save(osp.join(tmp_dir, 'ids.npy'), np.asarray(ids, dtype=np.str_))
+    with open(osp.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'height': height, 'width': width}, f, indent=4)
+    if osp.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+class FrameStore(object):
+    """Read-only view of a directory written by pack_frames.
+
+    The frame array is memory-mapped on first access, so a store can be handed
+    to DataLoader workers and every worker maps the same file.
+
+    Args:
+        store_dir (str): directory written by pack_frames.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(osp.join(store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.height, self.width = meta['height'], meta['width']
+        self.offsets = np.load(osp.join(store_dir, 'offsets.npy'))
+        ids = np.load(osp.join(store_dir, 'ids.npy'))
+        self.id2index = {str(key): i for i, key in enumerate(ids)}
+        self._frames = None
+
+    @property
+    def frames(self):
+        if self._frames is None:
+            self._frames = np.load(osp.join(self.store_dir, 'frames.npy'), mmap_mode='r')
+        return self._frames
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    def __contains__(self, key):
+        return key in self.id2index
+
+    def tracklet(self, key):
+        """All frames of a tracklet as a (num_frames, height, width, 3) view, no copy."""
+        i = self.id2index[key]
+        return self.frames[self.offsets[i]:self.offsets[i + 1]]
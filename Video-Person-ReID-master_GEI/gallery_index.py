@@ -0,0 +1,181 @@
+from __future__ import print_function, absolute_import
+import os
+import json
+import shutil
+import os.path as osp
+import numpy as np
+
+import torch
+
+from feature_store import FeatureStore
+from distance import distance_blocks
+from utils import mkdir_if_missing
+
+"""Persistent gallery of fused (appearance + energy image) tracklet features"""
+
+__all__ = ['GalleryIndex']
+
+
+class GalleryIndex(FeatureStore):
+    """Gallery that grows by enrollment instead of being rebuilt for every evaluation.
+
+    Rows are kept in append-only segments with the FeatureStore layout under
+    ``root``, so add() writes only the new rows and segments are loaded
+    lazily with mmap_mode='r'. remove() appends tombstones (tracklet id and
+    the first segment number it no longer applies to) to ``tombstones.txt``;
+    a removed id can be enrolled again later. compact() rewrites the live
+    rows into one segment and drops the tombstones.
+
+    Args:
+        root (str): index directory.
+        config (dict): json-serializable description of the features (checkpoint,
+            image size, pooling, ...). An index refuses to open with a different config.
+    """
+    def __init__(self, root, config=None):
+        self.store_dir = root
+        self.config = config if config is not None else {}
+        self._segments = None
+        self._id2row = None
+        self._ann = None
+        config_path = osp.join(root, 'config.json')
+        if osp.exists(config_path):
+            with open(config_path, 'r') as f:
+                stored = json.load(f)
+            if config is not None and stored != json.loads(json.dumps(config)):
+                raise ValueError("Gallery index {} was built with {}, not {}".format(root, stored, config))
+            self.config = stored
+
+    def _tombstones_path(self):
+        return osp.join(self.store_dir, 'tombstones.txt')
+
+    def _load(self):
+        if self._segments is not None:
+            return
+        super(GalleryIndex, self)._load()
+        if osp.exists(self._tombstones_path()):
+            with open(self._tombstones_path(), 'r') as f:
+                for line in f:
+                    tracklet_id, before = line.split()
+                    row = self._id2row.get(tracklet_id)
+                    if row is not None and self._seg_numbers[row[0]] < int(before):
+                        del self._id2row[tracklet_id]
+        self._ann = None
+        self._live = [np.zeros(len(segment['ids']), dtype=bool) for segment in self._segments]
+        for seg, row in self._id2row.values():
+            self._live[seg][row] = True
+
+    def ids(self):
+        """Ids of the enrolled tracklets."""
+        self._load()
+        return list(self._id2row.keys())
+
+    def add(self, tracklet_ids, features, pids, camids, seq_types):
+        """Enroll tracklets; ids already enrolled are ignored."""
+        mkdir_if_missing(self.store_dir)
+        super(GalleryIndex, self).add(tracklet_ids, features, pids, camids, seq_types)
+
+    def remove(self, tracklet_ids):
+        """Drop tracklets from the gallery. Returns the number of ids that were enrolled."""
+        self._load()
+        removed = [tracklet_id for tracklet_id in tracklet_ids if tracklet_id in self._id2row]
+        if removed:
+            with open(self._tombstones_path(), 'a') as f:
+                for tracklet_id in removed:
+                    f.write("{}\t{}\n".format(tracklet_id, self._next_segment()))
+            self._segments = None
+        return len(removed)
+
+    def gallery(self):
+        """All enrolled rows as (features, pids, camids, seq_types, ids) numpy arrays."""
+        self._load()
+        outputs = []
+        for name in ('features', 'pids', 'camids', 'seq_types', 'ids'):
+            parts = [np.asarray(segment[name][live]) for segment, live in zip(self._segments, self._live)]
+            outputs.append(np.concatenate(parts) if parts else np.zeros(0))
+        return tuple(outputs)
+
+    def search(self, query_features, k=10, metric='sqeuclidean', block_size=1024, gallery_block_size=8192,
+               backend=None):
+        """k nearest enrolled tracklets of every query.
+
+        By default the enrolled rows are searched exhaustively, gallery_block_size
+        rows at a time. Each block_size-by-gallery_block_size distance tile is cut
+        to its k nearest with argpartition and merged into the running top k, so
+        memory depends on the tile size and k, not on the gallery size. Ids are
+        looked up only for the final k. With an ann backend the enrolled rows are
+        indexed once (until the next add, remove or compact) and queries are
+        answered from it.
+
+        Args:
+            query_features (numpy.ndarray or torch.Tensor): (num_query, feat_dim) fused features.
+            k (int): number of neighbours, capped by the gallery size.
+            metric (str): see distance.pairwise_distance.
+            block_size (int): query rows per distance tile.
+            gallery_block_size (int): gallery rows per distance tile.
+            backend: an ann search backend, e.g. ann.create('ivf').
+
+        Returns:
+            distances (num_query, k) and ids (num_query, k), nearest first; ties
+            go to the earlier enrolled row. With a backend that finds fewer than
+            k candidates, missing ids are ''.
+        """
+        self._load()
+        if backend is not None:
+            return self._ann_search(query_features, k, metric, backend)
+        qf = torch.as_tensor(np.asarray(query_features, dtype=np.float32))
+        m, k = qf.size(0), min(k, len(self._id2row))
+        if k == 0:
+            return np.zeros((m, 0), dtype=np.float32), np.zeros((m, 0), dtype=np.str_)
+        best_dist = np.full((m, k), np.inf, dtype=np.float32)
+        best_rows = np.full((m, k), -1, dtype=np.int64)  # row in the concatenation of all segments
+        base = 0
+        for segment, live in zip(self._segments, self._live):
+            for start in range(0, len(live), gallery_block_size):
+                end = min(start + gallery_block_size, len(live))
+                block_live = live[start:end]
+                if not block_live.any():
+                    continue
+                gf = torch.from_numpy(np.array(segment['features'][start:end], dtype=np.float32))
+                for q_start, q_end, distmat in distance_blocks(qf, gf, block_size, metric):
+                    distmat[:, ~block_live] = np.inf
+                    top = min(k, distmat.shape[1])
+                    rows = np.argpartition(distmat, top - 1, axis=1)[:, :top]
+                    dist = np.concatenate((best_dist[q_start:q_end], np.take_along_axis(distmat, rows, 1)), 1)
+                    rows = np.concatenate((best_rows[q_start:q_end], rows + base + start), 1)
+                    keep = np.argpartition(dist, k - 1, axis=1)[:, :k]
+                    best_dist[q_start:q_end] = np.take_along_axis(dist, keep, 1)
+                    best_rows[q_start:q_end] = np.take_along_axis(rows, keep, 1)
+            base += len(live)
+
+        order = np.lexsort((best_rows, best_dist), axis=1)
+        best_dist, best_rows = np.take_along_axis(best_dist, order, 1), np.take_along_axis(best_rows, order, 1)
+        best_ids = np.zeros(best_rows.shape, dtype=np.result_type(*[s['ids'].dtype for s in self._segments]))
+        base = 0
+        for segment in self._segments:
+            in_segment = (best_rows >= base) & (best_rows < base + len(segment['ids']))
+            best_ids[in_segment] = np.asarray(segment['ids'])[best_rows[in_segment] - base]
+            base += len(segment['ids'])
+        return best_dist, best_ids
+
+    def _ann_search(self, query_features, k, metric, backend):
+        if self._ann != (backend, metric):
+            features, _, _, _, self._ann_ids = self.gallery()
+            backend.build(features, metric)
+            self._ann = (backend, metric)
+        dist, rows = backend.search(query_features, k)
+        return dist, np.where(rows >= 0, self._ann_ids[rows], '')
+
+    def compact(self):
+        """Rewrite the enrolled rows into a single segment and drop the tombstones."""
+        self._load()
+        old_dirs = [osp.join(self.store_dir, 'seg-{:05d}'.format(number)) for number in self._seg_numbers]
+        features, pids, camids, seq_types, ids = self.gallery()
+        if len(ids) > 0:
+            self._write_segment({'features': features, 'pids': pids, 'camids': camids,
+                                 'seq_types': seq_types, 'ids': ids})
+        # old segments go first: until the tombstones are gone, removed ids stay removed
+        for seg_dir in old_dirs:
+            shutil.rmtree(seg_dir)
+        if osp.exists(self._tombstones_path()):
+            os.remove(self._tombstones_path())
+        self._segments = None
@@ -0,0 +1,75 @@
+from __future__ import print_function, absolute_import
+import hashlib
+import os.path as osp
+import numpy as np
+
+from utils import mkdir_if_missing
+
+"""Energy image (GEI / MEAEI) features indexed by tracklet"""
+
+__all__ = ['gei_name', 'GEIIndex']
+
+
+def gei_name(tracklet):
+    """File name of a tracklet's energy image feature, e.g. '085-nm-01-c3.npy'.
+
+    The subject id is read from the frame file names, which carry the
+    original (not relabeled) CASIA id.
+    """
+    img_paths, _, camid, seq_type = tracklet
+    pid = osp.basename(img_paths[0])[:3]
+    return "{}-{}-c{}.npy".format(pid, seq_type, int(camid))
+
+
+class GEIIndex(object):
+    """Energy image features of a split, one row per tracklet.
+
+    The index is built from data_manager tracklet metadata only, no frame is
+    decoded. The first time a split is seen, every per-tracklet .npy file is
+    read once and the result is packed into a single array under
+    ``cache_dir``. Later runs load that array with one read, or map it with
+    ``mmap_mode='r'`` so that DataLoader workers share the pages.
+
+    Args:
+        gei_dir (str): directory of per-tracklet .npy energy image features.
+        tracklets (list): tracklets as returned by data_manager.
+        cache_dir (str): where packed arrays are kept (default: no packing).
+        mmap (bool): memory-map the packed array instead of loading it.
+    """
+    def __init__(self, gei_dir, tracklets, cache_dir=None, mmap=False):
+        self.gei_dir = gei_dir
+        self.names = [gei_name(tracklet) for tracklet in tracklets]
+
+        packed_path = None
+        if cache_dir:
+            sha = hashlib.sha1(osp.abspath(gei_dir).encode('utf-8'))
+            sha.update('\n'.join(self.names).encode('utf-8'))
+            packed_path = osp.join(cache_dir, 'gei-' + sha.hexdigest() + '.npy')
+
+        if packed_path is not None and osp.exists(packed_path):
+            self.features = np.load(packed_path, mmap_mode='r' if mmap else None)
+        else:
+            self.features = self._read_all()
+            if packed_path is not None:
+                mkdir_if_missing(cache_dir)
+                np.save(packed_path, self.features)
+                print("Packed {} energy image features to {}".format(len(self.names), packed_path))
+                if mmap:
+                    self.features = np.load(packed_path, mmap_mode='r')
+
+    def _read_all(self):
+        features = None
+        loaded = {}
+        for i, name in enumerate(self.names):
+            if name not in loaded:
+                loaded[name] = np.load(osp.join(self.gei_dir, name)).reshape(-1)
+            if features is None:
+                features = np.zeros((len(self.names), loaded[name].size), dtype=np.float32)
+            features[i] = loaded[name]
+        return features
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        return self.features[index]
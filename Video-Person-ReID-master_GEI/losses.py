@@ -2,8 +2,11 @@ from __future__ import absolute_import
 
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.autograd import Variable
 
+from distance import pairwise_distance, paired_distance
+
 """
 Shorthands for loss:
 - CrossEntropyLabelSmooth: xent
@@ -22,6 +25,7 @@ class CrossEntropyLabelSmooth(nn.Module):
     Args:
         num_classes (int): number of classes.
         epsilon (float): weight.
+        use_gpu (bool): unused, the loss runs on the device of its inputs. Kept for compatibility.
     """
     def __init__(self, num_classes, epsilon=0.1, use_gpu=True):
         super(CrossEntropyLabelSmooth, self).__init__()
@@ -37,12 +41,10 @@ class CrossEntropyLabelSmooth(nn.Module):
             targets: ground truth labels with shape (num_classes)
         """
         log_probs = self.logsoftmax(inputs)
-        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).data.cpu(), 1)  #
-
-        if self.use_gpu: targets = targets.cuda()
-        targets = Variable(targets, requires_grad=False)
-        targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
-        loss = (- targets * log_probs).mean(0).sum()
+        # sum_k -y_k * log p_k with y = (1 - epsilon) * one_hot + epsilon / K, without building y
+        nll = -log_probs.gather(1, targets.unsqueeze(1)).squeeze(1)
+        smooth = -log_probs.mean(dim=1)
+        loss = ((1 - self.epsilon) * nll + self.epsilon * smooth).mean()
         return loss
 
 class TripletLoss(nn.Module):
@@ -50,15 +52,25 @@ class TripletLoss(nn.Module):
 
     Reference:
     Hermans et al. In Defense of the Triplet Loss for Person Re-Identification. arXiv:1703.07737.
+    Schroff et al. FaceNet: A Unified Embedding for Face Recognition and Clustering. CVPR 2015.
 
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
 
     Args:
         margin (float): margin for triplet.
+        mining (str): 'hard' uses the hardest positive and negative of each anchor (batch hard),
+            'all' averages over all triplets with a non-zero loss (batch all),
+            'semihard' pairs every anchor-positive pair with the closest negative that is
+            farther than the positive, or the farthest negative if there is none.
     """
-    def __init__(self, margin=0.3):
+    mining_methods = ['hard', 'all', 'semihard']
+
+    def __init__(self, margin=0.3, mining='hard'):
         super(TripletLoss, self).__init__()
+        if mining not in self.mining_methods:
+            raise KeyError("Unknown mining method: {}. Expected one of {}".format(mining, self.mining_methods))
         self.margin = margin
+        self.mining = mining
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
 
     def forward(self, inputs, targets):
@@ -68,29 +80,47 @@ class TripletLoss(nn.Module):
             targets: ground truth labels with shape (num_classes)
         """
         n = inputs.size(0)
-        # Compute pairwise distance, replace by the official when merged
-        dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
-        dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
-        dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
-        # For each anchor, find the hardest positive and negative
+        dist = pairwise_distance(inputs, metric='euclidean')
         mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max())
-            dist_an.append(dist[i][mask[i] == 0].min())
-        # dist_ap = torch.cat(dist_ap)
-        # dist_an = torch.cat(dist_an)
-        dist_ap = torch.stack(dist_ap)
-        dist_an = torch.stack(dist_an)
+
+        if self.mining == 'all':
+            return self._batch_all(dist, mask)
+        if self.mining == 'semihard':
+            return self._semihard(dist, mask)
+
+        # For each anchor, find the hardest positive and negative
+        dist_ap = dist.masked_fill(~mask, float('-inf')).max(dim=1)[0]
+        dist_an = dist.masked_fill(mask, float('inf')).min(dim=1)[0]
         # Compute ranking hinge loss
-        y = dist_an.data.new()
-        y.resize_as_(dist_an.data)
-        y.fill_(1)
-        y = Variable(y)
+        y = torch.ones_like(dist_an)
         loss = self.ranking_loss(dist_an, dist_ap, y)
         return loss
 
+    def _triplet_masks(self, mask):
+        n = mask.size(0)
+        pos_mask = mask & ~torch.eye(n, dtype=torch.bool, device=mask.device)
+        return pos_mask, ~mask
+
+    def _batch_all(self, dist, mask):
+        pos_mask, neg_mask = self._triplet_masks(mask)
+        # loss[a, p, n] = d(a, p) - d(a, n) + margin over valid triplets
+        loss = dist.unsqueeze(2) - dist.unsqueeze(1) + self.margin
+        valid = pos_mask.unsqueeze(2) & neg_mask.unsqueeze(1)
+        loss = loss.clamp(min=0) * valid.to(loss.dtype)
+        num_active = (loss > 1e-16).sum()
+        return loss.sum() / num_active.clamp(min=1).to(loss.dtype)
+
+    def _semihard(self, dist, mask):
+        pos_mask, neg_mask = self._triplet_masks(mask)
+        dist_ap = dist.unsqueeze(2)  # (anchor, positive, 1)
+        dist_n = dist.unsqueeze(1)  # (anchor, 1, negative)
+        semihard = neg_mask.unsqueeze(1) & (dist_n > dist_ap)
+        closest_semihard = dist_n.masked_fill(~semihard, float('inf')).min(dim=2)[0]
+        farthest = dist.masked_fill(~neg_mask, float('-inf')).max(dim=1, keepdim=True)[0].expand_as(dist)
+        dist_an = torch.where(semihard.any(dim=2), closest_semihard, farthest)
+        loss = (dist - dist_an + self.margin).clamp(min=0)
+        return loss[pos_mask].mean()
+
 class CenterLoss(nn.Module):
     """Center loss.
     
@@ -100,12 +130,16 @@ class CenterLoss(nn.Module):
     Args:
         num_classes (int): number of classes.
         feat_dim (int): feature dimension.
+        sparse (bool): gather centers with a sparse gradient, so only the rows of the
+            classes in the batch are updated. Needs an optimizer that takes sparse
+            gradients (e.g. torch.optim.SparseAdam or SGD without weight decay).
     """
-    def __init__(self, num_classes=10, feat_dim=2, use_gpu=True):
+    def __init__(self, num_classes=10, feat_dim=2, use_gpu=True, sparse=False):
         super(CenterLoss, self).__init__()
         self.num_classes = num_classes
         self.feat_dim = feat_dim
         self.use_gpu = use_gpu
+        self.sparse = sparse
 
         if self.use_gpu:
             self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim).cuda())
@@ -118,23 +152,10 @@ class CenterLoss(nn.Module):
             x: feature matrix with shape (batch_size, feat_dim).
             labels: ground truth labels with shape (num_classes).
         """
-        batch_size = x.size(0)
-        distmat = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(batch_size, self.num_classes) + \
-                  torch.pow(self.centers, 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
-        distmat.addmm_(1, -2, x, self.centers.t())
-
-        classes = torch.arange(self.num_classes).long()
-        if self.use_gpu: classes = classes.cuda()
-        classes = Variable(classes)
-        labels = labels.unsqueeze(1).expand(batch_size, self.num_classes)
-        mask = labels.eq(classes.expand(batch_size, self.num_classes))
-
-        dist = []
-        for i in range(batch_size):
-            value = distmat[i][mask[i]]
-            value = value.clamp(min=1e-12, max=1e+12) # for numerical stability
-            dist.append(value)
-        dist = torch.cat(dist)
+        # only the batch_size sample-to-own-center distances are needed
+        centers = F.embedding(labels, self.centers, sparse=self.sparse)
+        dist = paired_distance(x, centers, metric='sqeuclidean')
+        dist = dist.clamp(min=1e-12, max=1e+12) # for numerical stability
         loss = dist.mean()
 
         return loss
@@ -1,6 +1,9 @@
 from __future__ import print_function, absolute_import
 import os
 import sys
+import copy
+import json
+import hashlib
 import time
 import datetime
 import argparse
@@ -10,19 +13,28 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
 
 import data_manager
-from video_loader import VideoDataset
+import frame_sampling
+from video_loader import VideoDataset, VideoChunkDataset, ImageReader, dense_collate_fn
 import transforms as T
 import models
 from models import resnet3d
 from losses import CrossEntropyLabelSmooth, TripletLoss
-from utils import AverageMeter, Logger, save_checkpoint
-from eval_metrics import evaluate
-from samplers import RandomIdentitySampler
+from utils import AverageMeter, Logger, save_checkpoint, tracklet_id
+from eval_metrics import RankAccumulator
+import distance
+import ann
+from distance import distance_blocks
+from feature_store import FeatureStore, FrameFeatureStore, checkpoint_hash
+from gallery_index import GalleryIndex
+from gei_index import GEIIndex
+from frame_store import FrameStore, pack_frames
+from frame_cache import FrameCache
+from samplers import RandomIdentitySampler, ConditionBalancedSampler, LengthBucketBatchSampler
 
 parser = argparse.ArgumentParser(description='Train video model with cross entropy loss')
 # Datasets
@@ -35,6 +47,22 @@ parser.add_argument('--height', type=int, default=224,
 parser.add_argument('--width', type=int, default=112,
                     help="width of an image (default: 112)")
 parser.add_argument('--seq-len', type=int, default=4, help="number of images to sample in a tracklet")
+parser.add_argument('--sample', type=str, default='random', choices=frame_sampling.clip_methods,
+                    help="how training clips are sampled from a tracklet: random (consecutive frames), "
+                         "strided, segment (one frame per segment, TSN), evenly (default: random)")
+parser.add_argument('--sample-stride', type=int, default=2, help="frame step of --sample strided")
+parser.add_argument('--gei-dir', type=str, default="/media/work401/880AA9210AA90CEE/lxy/2020-03-15/GEI_npy",
+                    help="directory of per-tracklet energy image features (.npy)")
+parser.add_argument('--gei-cache-dir', type=str, default='',
+                    help="where packed energy image features are kept (default: <save-dir>/gei_cache)")
+parser.add_argument('--read-retries', type=int, default=3,
+                    help="retries with exponential backoff before a frame file is quarantined (default: 3)")
+parser.add_argument('--read-fallback', type=str, default='repeat', choices=ImageReader.fallbacks,
+                    help="replace a quarantined frame by its neighbour, drop it, or raise (default: repeat)")
+parser.add_argument('--frame-store', type=str, default='',
+                    help="directory of packed, pre-resized frames; packed on first use (default: read image files)")
+parser.add_argument('--frame-cache', type=int, default=0,
+                    help="number of decoded frames per split kept in a shared-memory LRU cache (default: 0, off)")
 # Optimization options
 parser.add_argument('--max-epoch', default=400, type=int,
                     help="maximum epochs to run")
@@ -42,7 +70,18 @@ parser.add_argument('--start-epoch', default=0, type=int,
                     help="manual epoch number (useful on restarts)")
 parser.add_argument('--train-batch', default=32, type=int,
                     help="train batch size")
-parser.add_argument('--test-batch', default=1, type=int, help="has to be 1")
+parser.add_argument('--test-batch', default=8, type=int, help="number of tracklets per test batch")
+parser.add_argument('--test-clip-batch', default=32, type=int,
+                    help="number of clips per forward pass in testing, packed across tracklets (default: 32)")
+parser.add_argument('--eval-frames', action='store_true',
+                    help="pool test features over all frames of a tracklet in one streamed pass "
+                         "instead of over dense clips (temporal-pooling models such as resnet50tp)")
+parser.add_argument('--stream-test', action='store_true',
+                    help="stream test tracklets as chunks of --test-clip-batch x --seq-len frames, "
+                         "so loader memory does not grow with tracklet length")
+parser.add_argument('--bucket-test', action='store_true',
+                    help="batch test tracklets with the same dense clip count together, "
+                         "about --test-clip-batch clips per batch")
 parser.add_argument('--lr', '--learning-rate', default=0.0003, type=float,
                     help="initial learning rate, use 0.0001 for rnn, use 0.0003 for pooling and attention")
 parser.add_argument('--stepsize', default=200, type=int,
@@ -52,8 +91,16 @@ parser.add_argument('--gamma', default=0.1, type=float,
 parser.add_argument('--weight-decay', default=5e-04, type=float,
                     help="weight decay (default: 5e-04)")
 parser.add_argument('--margin', type=float, default=0.3, help="margin for triplet loss")
+parser.add_argument('--htri-mining', type=str, default='hard', choices=TripletLoss.mining_methods,
+                    help="triplet mining: batch hard, batch all or semi-hard (default: hard)")
 parser.add_argument('--num-instances', type=int, default=4,
                     help="number of instances per identity")
+parser.add_argument('--sampler', type=str, default='identity', choices=['identity', 'condition'],
+                    help="P x K sampler: random instances per identity, or a fixed quota per "
+                         "walking condition (default: identity)")
+parser.add_argument('--condition-quota', type=str, default='',
+                    help="instances per condition for --sampler condition, e.g. 'nm:2,bg:1,cl:1' "
+                         "(default: even split)")
 parser.add_argument('--htri-only', action='store_true', default=False,
                     help="if this is True, only htri loss is used in training")
 # Architecture
@@ -70,12 +117,42 @@ parser.add_argument('--pretrained-model', type=str,
 parser.add_argument('--evaluate', action='store_true', help="evaluation only")
 parser.add_argument('--eval-step', type=int, default=50,
                     help="run evaluation for every N epochs (set to -1 to test after training)")
+parser.add_argument('--partial-rank', action='store_true',
+                    help="rank positives by binary search into sorted distances instead of a full argsort in evaluation "
+                         "(faster and lighter on large galleries)")
+parser.add_argument('--eval-tile', type=int, default=1024,
+                    help="number of query rows per distance tile in evaluation (default: 1024)")
+parser.add_argument('--eval-metric', type=str, default='sqeuclidean', choices=distance.metrics,
+                    help="distance used for ranking in evaluation (default: sqeuclidean)")
+parser.add_argument('--eval-precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                    help="precision the query-gallery matrix product inputs are rounded to; the product is "
+                         "accumulated in fp32 (default: fp32)")
+parser.add_argument('--ann', type=str, default='', choices=[''] + ann.backends,
+                    help="rank the gallery with a nearest-neighbour search backend instead of the full distance "
+                         "matrix; only the --ann-k nearest are scored, unretrieved positives count as misses "
+                         "(default: off)")
+parser.add_argument('--ann-k', type=int, default=100, help="gallery samples retrieved per query with --ann")
+parser.add_argument('--ann-recall', action='store_true',
+                    help="also run exact search and report recall@k and latency of --ann against it")
+parser.add_argument('--ann-nlist', type=int, default=100, help="number of k-means lists of the ivf backends")
+parser.add_argument('--ann-nprobe', type=int, default=8, help="lists visited per query by the ivf backends")
+parser.add_argument('--feature-store', type=str, default='',
+                    help="directory to cache gallery features per checkpoint, reused across evaluations (default: off)")
+parser.add_argument('--gallery-index', type=str, default='',
+                    help="directory of a persistent gallery index per checkpoint: new gallery tracklets are "
+                         "enrolled, and queries are ranked against everything enrolled so far (default: off)")
+parser.add_argument('--frame-feature-store', type=str, default='',
+                    help="directory to cache per-frame features per checkpoint; test features are composed "
+                         "from them, so every frame runs once and --seq-len/--pool changes are free (default: off)")
 parser.add_argument('--save-dir', type=str, default='log')
 parser.add_argument('--use-cpu', action='store_true', help="use cpu")
 parser.add_argument('--gpu-devices', default='0', type=str, help='gpu device ids for CUDA_VISIBLE_DEVICES')
 
 args = parser.parse_args()
 
+# clips leave the loaders as uint8, ToTensor scaling and Normalize run once per batch
+batch_normalize = T.BatchNormalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
 
 def main():
     file_name = "result_all_v3.0.txt"
@@ -106,73 +183,84 @@ def main():
     print("Initializing dataset {}".format(args.dataset))
     dataset = data_manager.init_dataset(name=args.dataset)
 
+    #####整段clip共用一次裁剪/翻转参数，归一化在batch上统一做(batch_normalize)
     transform_train = T.Compose([
-        T.Random2DTranslation(args.height, args.width),
-        T.RandomHorizontalFlip(),
-        T.ToTensor(),
-        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        T.ClipRandom2DTranslation(args.height, args.width),
+        T.ClipRandomHorizontalFlip(),
+        T.ClipToTensor(),
     ])
 
     transform_test = T.Compose([
-        T.Resize((args.height, args.width)),
-        T.ToTensor(),
-        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        T.ClipResize(args.height, args.width),
+        T.ClipToTensor(),
     ])
 
     pin_memory = True if use_gpu else False
     # sampler = RandomIdentitySampler(dataset.train, num_instances=args.num_instances)
     # print(format(sampler))
 
-    GEI_dir = "/media/work401/880AA9210AA90CEE/lxy/2020-03-15/GEI_npy"
-
+    reader = ImageReader(max_retries=args.read_retries, fallback=args.read_fallback,
+                         quarantine_path=osp.join(args.save_dir, 'quarantine.txt'))
+
+    # train frames are kept at the 1.125x size Random2DTranslation crops from
+    train_size = (int(round(args.height * 1.125)), int(round(args.width * 1.125)))
+    train_cache, test_cache = None, None
+    if args.frame_cache > 0:
+        train_cache = FrameCache(args.frame_cache, *train_size)
+        test_cache = FrameCache(args.frame_cache, args.height, args.width)
+
+    train_store, test_store = None, None
+    if args.frame_store:
+        train_store_dir = osp.join(args.frame_store, 'bbox_train_{}x{}'.format(*train_size))
+        test_store_dir = osp.join(args.frame_store, 'bbox_test_{}x{}'.format(args.height, args.width))
+        if not osp.exists(train_store_dir):
+            pack_frames(dataset.train, train_store_dir, *train_size)
+        if not osp.exists(test_store_dir):
+            pack_frames(dataset.query + dataset.gallery, test_store_dir, args.height, args.width)
+        train_store, test_store = FrameStore(train_store_dir), FrameStore(test_store_dir)
+
+    test_sample = 'all' if args.eval_frames else 'dense'
+
+    def test_loader(tracklets):
+        video = VideoDataset(tracklets, seq_len=args.seq_len, sample=test_sample, clip_transform=transform_test,
+                             frame_store=test_store, reader=reader, frame_cache=test_cache)
+        if args.stream_test:
+            return DataLoader(VideoChunkDataset(video, chunk_size=args.test_clip_batch * args.seq_len),
+                              batch_size=None, num_workers=args.workers, pin_memory=pin_memory)
+        if args.bucket_test:
+            batching = {'batch_sampler': LengthBucketBatchSampler(tracklets, args.seq_len, args.test_batch,
+                                                                  max_clips=args.test_clip_batch)}
+        else:
+            batching = {'batch_size': args.test_batch, 'shuffle': False, 'drop_last': False}
+        return DataLoader(video, num_workers=args.workers, pin_memory=pin_memory, collate_fn=dense_collate_fn,
+                          **batching)
+
+    queryloader = test_loader(dataset.query)
+    galleryloader = test_loader(dataset.gallery)
+
+    #######步态能量特征直接由轨迹的元数据索引，不需要遍历图像
+    gei_cache_dir = args.gei_cache_dir or osp.join(args.save_dir, 'gei_cache')
+    train_GEI = GEIIndex(args.gei_dir, dataset.train, cache_dir=gei_cache_dir, mmap=True)
+    query_GEI = GEIIndex(args.gei_dir, dataset.query, cache_dir=gei_cache_dir).features
+    gallery_GEI = GEIIndex(args.gei_dir, dataset.gallery, cache_dir=gei_cache_dir).features
+    print("Loaded energy image features: train {}, query {}, gallery {}".format(
+        len(train_GEI), len(query_GEI), len(gallery_GEI)))
+
+    if args.sampler == 'condition':
+        train_sampler = ConditionBalancedSampler(dataset.train, num_instances=args.num_instances,
+                                                 quota=args.condition_quota or None, seed=args.seed)
+        print("Condition quota per identity: {}".format(train_sampler.quota))
+    else:
+        train_sampler = RandomIdentitySampler(dataset.train, num_instances=args.num_instances, seed=args.seed)
     trainloader = DataLoader(
-        VideoDataset(dataset.train, seq_len=args.seq_len, sample='random', transform=transform_train),
-        sampler=RandomIdentitySampler(dataset.train, num_instances=args.num_instances),
+        VideoDataset(dataset.train, seq_len=args.seq_len, sample=args.sample, clip_transform=transform_train,
+                     gei=train_GEI, frame_store=train_store, reader=reader, frame_cache=train_cache,
+                     stride=args.sample_stride),
+        sampler=train_sampler,
         batch_size=args.train_batch, num_workers=args.workers,
         pin_memory=pin_memory, drop_last=True,
     )
 
-    #######trainloader 中包含每个batchsize中轨迹的名称，接下来只要加载对应的GEI img
-    def load_GEI(GEI_dir, loader, batchsize):
-        dir = GEI_dir
-        GEI_list = []
-        GEI_npys = np.zeros((batchsize, 2048))
-
-        for batch_idx, (imgs, pids, cids, seq_type) in enumerate(loader):
-            cids = cids.to(torch.int8)
-            for i in range(batchsize):
-                if pids[i] < 84:
-                    pid = "%03d" % (pids[i] + 1)
-                else:
-                    pid = "%03d" % pids[i]
-                cid = "c" + str(cids[i].item())
-                GEI_name = str(pid) + "-" + seq_type[i] + "-" + str(cid) + ".npy"
-                GEI_name = os.path.join(dir, GEI_name)
-                GEI_file = np.load(GEI_name).reshape(1, -1)
-                GEI_npys[i] = GEI_file
-            GEI_list.append(GEI_npys)
-
-        return GEI_list
-
-    train_GEI = load_GEI(GEI_dir, trainloader, args.train_batch)
-    print("finished train_GEI###########")
-
-    queryloader = DataLoader(
-        VideoDataset(dataset.query, seq_len=args.seq_len, sample='dense', transform=transform_test),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
-    )
-    query_GEI = load_GEI(GEI_dir, queryloader, args.test_batch)
-    print("finished query_GEI ###########")
-
-    galleryloader = DataLoader(
-        VideoDataset(dataset.gallery, seq_len=args.seq_len, sample='dense', transform=transform_test),
-        batch_size=args.test_batch, shuffle=False, num_workers=args.workers,
-        pin_memory=pin_memory, drop_last=False,
-    )
-    gallery_GEI = load_GEI(GEI_dir, galleryloader, args.test_batch)
-    print("finished gallery_GEI ################")
-
     print("Initializing model: {}".format(args.arch))
     if args.arch == 'resnet503d':
         model = resnet3d.resnet50(num_classes=dataset.num_train_pids, sample_width=args.width,
@@ -189,9 +277,13 @@ def main():
     else:
         model = models.init_model(name=args.arch, num_classes=dataset.num_train_pids, loss={'xent', 'htri'})
     print("Model size: {:.5f}M".format(sum(p.numel() for p in model.parameters()) / 1000000.0))
+    if args.eval_frames or args.frame_feature_store:
+        # frame-level evaluation relies on a clip feature being the mean of its frames' features
+        assert hasattr(model, 'frame_features'), \
+            "Error: --eval-frames and --frame-feature-store need a temporal-pooling model, e.g. resnet50tp"
 
-    criterion_xent = CrossEntropyLabelSmooth(num_classes=dataset.num_train_pids, use_gpu=use_gpu)
-    criterion_htri = TripletLoss(margin=args.margin)
+    criterion_xent = CrossEntropyLabelSmooth(num_classes=dataset.num_train_pids)
+    criterion_htri = TripletLoss(margin=args.margin, mining=args.htri_mining)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     if args.stepsize > 0:
@@ -213,8 +305,12 @@ def main():
         torch.backends.cudnn.benchmark = False
     for epoch in range(start_epoch, args.max_epoch):
         print("==> Epoch {}/{}".format(epoch + 1, args.max_epoch))
+        train_sampler.set_epoch(epoch)
 
-        train(model, criterion_xent, criterion_htri, optimizer, trainloader, train_GEI, use_gpu)
+        train(model, criterion_xent, criterion_htri, optimizer, trainloader, use_gpu)
+        print("Image reader: {}".format(reader.summary()))
+        if train_cache is not None:
+            print("Frame cache: {}".format(train_cache.summary()))
 
         if args.stepsize > 0: scheduler.step()
 
@@ -239,17 +335,16 @@ def main():
     print("Finished. Total elapsed time (h:m:s): {}".format(elapsed))
 
 
-def train(model, criterion_xent, criterion_htri, optimizer, trainloader, train_GEI, use_gpu):
+def train(model, criterion_xent, criterion_htri, optimizer, trainloader, use_gpu):
     model.train()
     losses = AverageMeter()
 
-    for batch_idx, (imgs, pids, camid, seqt_ype) in enumerate(trainloader):
-        #####加载同一批次的GEI numpy file
-        GEI_features = train_GEI[batch_idx]
-        GEI_features = torch.from_numpy(GEI_features)
+    for batch_idx, (imgs, pids, camid, seqt_ype, GEI_features) in enumerate(trainloader):
+        #####每个样本自带其轨迹的GEI特征
         if use_gpu:
             imgs, pids, GEI_features = imgs.cuda(), pids.cuda(), GEI_features.cuda()
-        imgs, pids, GEI_features = Variable(imgs), Variable(pids).type(torch.LongTensor), Variable(GEI_features).float()
+        imgs = batch_normalize(imgs)
+        imgs, pids, GEI_features = Variable(imgs), Variable(pids).long(), Variable(GEI_features).float()
 
         #####数据和步态能量特征一同输入到网络中训练
         outputs, features = model(imgs, GEI_features)
@@ -271,86 +366,331 @@ def train(model, criterion_xent, criterion_htri, optimizer, trainloader, train_G
             print("Batch {}/{}\t Loss {:.6f} ({:.6f})".format(batch_idx + 1, len(trainloader), losses.val, losses.avg))
 
 
-def test(model, queryloader, galleryloader, query_GEI, gallery_GEI, pool, use_gpu, result_file, ranks=[1, 5, 10, 20]):
-    model.eval()
-    qf, q_pids, q_camids, q_seq_types = [], [], [], []
-    for batch_idx, (imgs, pids, camids, seq_types) in enumerate(queryloader):
-        GEI_q_features = query_GEI[batch_idx]
-        GEI_q_features = torch.from_numpy(GEI_q_features).squeeze().float()
-        # print("pids:\n", pids, "camids:\n", camids, "seq_type:\n", seq_type)
+def pool_segments(pooled, features, segments, pool):
+    """Pool clip features into per-tracklet rows of ``pooled`` (sum for 'avg', max for 'max')."""
+    if pool == 'avg':
+        pooled.index_add_(0, segments, features)
+        return
+    seg_ids, seg_counts = torch.unique_consecutive(segments, return_counts=True)
+    for seg, seg_features in zip(seg_ids.tolist(), torch.split(features, seg_counts.tolist())):
+        pooled[seg] = torch.max(pooled[seg], seg_features.max(0)[0])
 
-        if use_gpu:
-            imgs = imgs.cuda()
-
-        with  torch.no_grad():
-            imgs = Variable(imgs)
-
-        # b=1, n=number of clips, s=16
-        b, n, s, c, h, w = imgs.size()
-        assert (b == 1)
-        imgs = imgs.view(b * n, s, c, h, w)
-        features = model(imgs)
-        features = features.view(n, -1)
-        features = torch.mean(features, 0)
-        features = features.data.cpu()
-        features = torch.cat((features, GEI_q_features), 0)
-        qf.append(features)
-        q_pids.extend(pids)
-        q_camids.extend(camids)
-        q_seq_types.extend(seq_types)
-
-    qf = torch.stack(qf)
-    q_pids = np.asarray(q_pids)
-    q_camids = np.asarray(q_camids)
-    q_seq_types =np.asarray(q_seq_types)
-    #####当q_pid和q_camid相同时，可能存在seq_type不一样的情况，这点是否也要算进去?？?
 
-    print("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
+def num_tracklets_of(loader):
+    if isinstance(loader.dataset, VideoChunkDataset):
+        return loader.dataset.num_tracklets
+    return len(loader.dataset)
+
 
-    gf, g_pids, g_camids, g_seq_types = [], [], [],[]
-    for batch_idx, (imgs, pids, camids, seq_types) in enumerate(galleryloader):
-        GEI_g_features = gallery_GEI[batch_idx]
-        GEI_g_features = torch.from_numpy(GEI_g_features).squeeze().float()
+def sample_of(loader):
+    dataset = loader.dataset
+    if isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return dataset.sample
 
+
+def tracklet_units(loader):
+    """Iterate a test loader as (clips, positions, num_clips, pids, camids, seq_types).
+
+    ``clips`` holds num_clips[i] clips (or frames) of the tracklet at dataset
+    position positions[i]. Works for batching loaders over a VideoDataset,
+    in the (repeatable) order of their batch sampler, and for streaming
+    VideoChunkDataset loaders, whose chunks carry their position; a tracklet
+    may then show up in several units.
+    """
+    if isinstance(loader.dataset, VideoChunkDataset):
+        for chunk, position, pid, camid, seq_type in loader:
+            yield (chunk, torch.LongTensor([position]), torch.LongTensor([chunk.size(0)]),
+                   torch.LongTensor([pid]), torch.LongTensor([camid]), [seq_type])
+        return
+    order = torch.LongTensor([index for batch in loader.batch_sampler for index in batch])
+    next_tracklet = 0
+    for clips, num_clips, pids, camids, seq_types in loader:
+        b = num_clips.size(0)
+        yield clips, order[next_tracklet:next_tracklet + b], num_clips, pids, camids, seq_types
+        next_tracklet += b
+
+
+def extract_features(model, loader, pool, use_gpu):
+    """Run the model over every tracklet of a dense-sampling loader.
+
+    Clips of consecutive tracklets are packed into forward batches of
+    --test-clip-batch clips, and the clip features are pooled back into one
+    feature per tracklet. The loader's batch sampler may visit tracklets in
+    any (repeatable) order, e.g. LengthBucketBatchSampler, or the loader may
+    stream chunks of tracklets (--stream-test); outputs are returned in
+    dataset order.
+
+    With a sample='all' loader (--eval-frames) the units are single frames
+    instead of clips: frames are streamed in chunks of --test-clip-batch x
+    --seq-len as one-frame clips and pooled straight into the tracklet
+    feature, so no clip is padded and the average weighs every frame once.
+    """
+    model.eval()
+    num_tracklets = num_tracklets_of(loader)
+    frames_only = sample_of(loader) == 'all'
+    forward_batch = args.test_clip_batch * args.seq_len if frames_only else args.test_clip_batch
+    pooled = None
+    total_clips = torch.zeros(num_tracklets)
+    pids_array = np.zeros(num_tracklets, dtype=np.int64)
+    camids_array = np.zeros(num_tracklets, dtype=np.int64)
+    seq_types_array = np.empty(num_tracklets, dtype=object)
+
+    def forward(clips, segments, pooled):
         if use_gpu:
-            imgs = imgs.cuda()
-        with torch.no_grad():
-            imgs = Variable(imgs)
-        b, n, s, c, h, w = imgs.size()
-        imgs = imgs.view(b * n, s, c, h, w)
-        assert (b == 1)
-        features = model(imgs)
-        features = features.view(n, -1)
-        if pool == 'avg':
-            features = torch.mean(features, 0)
+            clips = clips.cuda()
+        clips = batch_normalize(clips)
+        if frames_only:
+            clips = clips.unsqueeze(1)  # (frames, c, h, w) -> one-frame clips
+        features = model(clips).data.cpu()
+        if pooled is None:
+            pooled = torch.full((num_tracklets, features.size(1)), 0. if pool == 'avg' else -float('inf'))
+        pool_segments(pooled, features, segments, pool)
+        return pooled
+
+    clip_buffer, segment_buffer = [], []
+    num_buffered = 0
+    with torch.no_grad():
+        for clips, positions, num_clips, pids, camids, seq_types in tracklet_units(loader):
+            # b=number of tracklets, n=number of clips of all of them, s=16
+            segments = positions.repeat_interleave(num_clips)
+            total_clips.index_add_(0, positions, num_clips.float())
+            pids_array[positions.numpy()] = pids.numpy()
+            camids_array[positions.numpy()] = camids.numpy()
+            seq_types_array[positions.numpy()] = seq_types
+
+            clip_buffer.append(clips)
+            segment_buffer.append(segments)
+            num_buffered += clips.size(0)
+            if num_buffered < forward_batch:
+                continue
+            clips, segments = torch.cat(clip_buffer), torch.cat(segment_buffer)
+            num_full = clips.size(0) - clips.size(0) % forward_batch
+            for start in range(0, num_full, forward_batch):
+                end = start + forward_batch
+                pooled = forward(clips[start:end], segments[start:end], pooled)
+            clip_buffer, segment_buffer = [clips[num_full:]], [segments[num_full:]]
+            num_buffered = clips.size(0) - num_full
+
+        if num_buffered > 0:
+            pooled = forward(torch.cat(clip_buffer), torch.cat(segment_buffer), pooled)
+
+    if pool == 'avg':
+        pooled /= total_clips.unsqueeze(1)
+    return pooled, pids_array, camids_array, np.asarray(seq_types_array.tolist())
+
+
+def subset_loader(loader, indices):
+    """A test loader like ``loader`` over the tracklets at ``indices`` only."""
+    if isinstance(loader.dataset, VideoChunkDataset):
+        return DataLoader(
+            VideoChunkDataset(loader.dataset.video, loader.dataset.chunk_size, indices=indices),
+            batch_size=None, num_workers=loader.num_workers, pin_memory=loader.pin_memory,
+        )
+    if isinstance(loader.batch_sampler, LengthBucketBatchSampler):
+        buckets = loader.batch_sampler
+        batching = {'batch_sampler': LengthBucketBatchSampler(
+            [loader.dataset.dataset[i] for i in indices], buckets.seq_len, buckets.batch_size, buckets.max_clips)}
+    else:
+        batching = {'batch_size': loader.batch_size, 'shuffle': False, 'drop_last': False}
+    return DataLoader(
+        Subset(loader.dataset, indices), num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory, collate_fn=loader.collate_fn, **batching
+    )
+
+
+def extract_stored_features(model, loader, pool, use_gpu):
+    """extract_features backed by the --feature-store cache.
+
+    Only tracklets that the store does not hold for the current weights and
+    sampling config go through the model.
+    """
+    config = {'arch': args.arch, 'seq_len': args.seq_len, 'height': args.height, 'width': args.width,
+              'sample': loader.dataset.sample, 'pool': pool}
+    store = FeatureStore(args.feature_store, model, config)
+    ids = [tracklet_id(img_paths) for img_paths, _, _, _ in loader.dataset.dataset]
+    missing = store.missing(ids)
+    print("Feature store {}: {} of {} tracklets cached".format(store.store_dir, len(ids) - len(missing), len(ids)))
+    if missing:
+        features, pids, camids, seq_types = extract_features(model, subset_loader(loader, missing), pool, use_gpu)
+        store.add([ids[i] for i in missing], features.numpy(), pids, camids, seq_types)
+    features, pids, camids, seq_types = store.get(ids)
+    return torch.from_numpy(features), pids, camids, seq_types
+
+
+def enroll_gallery(model, loader, gallery_GEI, pool, use_gpu):
+    """Enroll the gallery split into the --gallery-index and return every enrolled tracklet.
+
+    Only tracklets the index does not hold yet go through the model; their
+    fused appearance + energy image features are appended as a new segment.
+    Tracklets enrolled by earlier runs stay in the gallery.
+
+    Returns:
+        fused features, pids, camids, seq_types of the whole index.
+    """
+    config = {'checkpoint': checkpoint_hash(model), 'arch': args.arch, 'seq_len': args.seq_len,
+              'height': args.height, 'width': args.width, 'sample': loader.dataset.sample, 'pool': pool}
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+    index = GalleryIndex(osp.join(args.gallery_index, key), config)
+    ids = [tracklet_id(img_paths) for img_paths, _, _, _ in loader.dataset.dataset]
+    missing = index.missing(ids)
+    print("Gallery index {}: enrolling {} new of {} tracklets".format(index.store_dir, len(missing), len(ids)))
+    if missing:
+        features, pids, camids, seq_types = extract_features(model, subset_loader(loader, missing), pool, use_gpu)
+        features = torch.cat((features, torch.from_numpy(np.asarray(gallery_GEI)[missing]).float()), 1)
+        index.add([ids[i] for i in missing], features.numpy(), pids, camids, seq_types)
+    features, pids, camids, seq_types, _ = index.gallery()
+    return torch.from_numpy(features), pids, camids, seq_types
+
+
+def extract_frame_features(model, loader, use_gpu):
+    """Per-frame features of every tracklet of a sample='all' loader.
+
+    Every frame goes through the backbone once, in forward batches of at most
+    --test-clip-batch x --seq-len frames. A frame is fed as a one-frame clip,
+    whose feature is the frame feature (see ResNet50TP.frame_features).
+
+    Returns:
+        list of (num_frames, feat_dim) numpy arrays, then pids, camids, seq_types.
+    """
+    model.eval()
+    chunk_size = args.test_clip_batch * args.seq_len
+    num_tracklets = num_tracklets_of(loader)
+    frame_features = [[] for _ in range(num_tracklets)]
+    pids_array = np.zeros(num_tracklets, dtype=np.int64)
+    camids_array = np.zeros(num_tracklets, dtype=np.int64)
+    seq_types_array = np.empty(num_tracklets, dtype=object)
+    with torch.no_grad():
+        for frames, positions, num_frames, pids, camids, seq_types in tracklet_units(loader):
+            outputs = []
+            for start in range(0, frames.size(0), chunk_size):
+                x = frames[start:start + chunk_size]
+                if use_gpu:
+                    x = x.cuda()
+                outputs.append(model(batch_normalize(x).unsqueeze(1)).data.cpu())
+            for position, features in zip(positions.tolist(), torch.cat(outputs).split(num_frames.tolist())):
+                frame_features[position].append(features)
+            pids_array[positions.numpy()] = pids.numpy()
+            camids_array[positions.numpy()] = camids.numpy()
+            seq_types_array[positions.numpy()] = seq_types
+    frame_features = [torch.cat(features).numpy() for features in frame_features]
+    return frame_features, pids_array, camids_array, np.asarray(seq_types_array.tolist())
+
+
+def compose_features(frame_features, seq_len, pool):
+    """Tracklet features composed from per-frame features.
+
+    Gives what dense sampling with ``seq_len`` frames per clip followed by
+    ``pool`` over the clips would, without running any frame twice. With
+    ``seq_len`` None the frames are pooled directly, as with --eval-frames.
+    """
+    tracklet_features = []
+    for features in frame_features:
+        features = torch.from_numpy(np.array(features, dtype=np.float32))
+        if seq_len is None:
+            clips = features  # pool over the frames themselves
         else:
-            features, _ = torch.max(features, 0)
-
-        # print("features.size #########",features.size())
-        # print("GEI_g_features ########",GEI_g_features)
-        features = features.data.cpu()
-        features = torch.cat((features, GEI_g_features), 0)
-        gf.append(features)
-        g_pids.extend(pids)
-        g_camids.extend(camids)
-        g_seq_types.extend(seq_types)
-
-    gf = torch.stack(gf)
-    g_pids = np.asarray(g_pids)
-    g_camids = np.asarray(g_camids)
-    g_seq_types = np.asarray(g_seq_types)
-    print("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
-    print("Computing distance matrix")
+            clips = features[torch.from_numpy(frame_sampling.dense(features.size(0), seq_len))].mean(1)
+        tracklet_features.append(clips.mean(0) if pool == 'avg' else clips.max(0)[0])
+    return torch.stack(tracklet_features)
+
+
+def extract_composed_features(model, loader, pool, use_gpu):
+    """extract_features on top of the --frame-feature-store cache of per-frame features.
+
+    Frame features only depend on the weights and the image size, so a
+    change of --seq-len or --pool is served from the store.
+    """
+    config = {'arch': args.arch, 'height': args.height, 'width': args.width}
+    store = FrameFeatureStore(args.frame_feature_store, model, config)
+    ids = [tracklet_id(img_paths) for img_paths, _, _, _ in loader.dataset.dataset]
+    missing = store.missing(ids)
+    print("Frame feature store {}: {} of {} tracklets cached".format(
+        store.store_dir, len(ids) - len(missing), len(ids)))
+    if missing:
+        streaming = isinstance(loader.dataset, VideoChunkDataset)
+        frame_dataset = copy.copy(loader.dataset.video if streaming else loader.dataset)
+        frame_dataset.sample = 'all'
+        if streaming:
+            frame_loader = DataLoader(
+                VideoChunkDataset(frame_dataset, loader.dataset.chunk_size, indices=missing),
+                batch_size=None, num_workers=loader.num_workers, pin_memory=loader.pin_memory,
+            )
+        else:
+            frame_loader = DataLoader(
+                Subset(frame_dataset, missing), batch_size=args.test_batch, shuffle=False,
+                num_workers=loader.num_workers, pin_memory=loader.pin_memory, drop_last=False,
+                collate_fn=dense_collate_fn,
+            )
+        frame_features, pids, camids, seq_types = extract_frame_features(model, frame_loader, use_gpu)
+        store.add([ids[i] for i in missing], frame_features, pids, camids, seq_types)
+    frame_features, pids, camids, seq_types = store.get(ids)
+    seq_len = None if loader.dataset.sample == 'all' else args.seq_len
+    return compose_features(frame_features, seq_len, pool), pids, camids, seq_types
+
+
+def ann_rank(qf, gf, q_pids, q_camids, q_seq_types, accumulator):
+    """Rank for --ann: only the --ann-k nearest gallery samples a backend returns per query are scored.
+
+    CMC and AP are computed from these lists (RankAccumulator.update_topk);
+    positives that were not retrieved count as misses, so mAP is truncated at
+    k. With --ann-recall the lists are compared with exact search.
+    """
+    k = min(args.ann_k, gf.size(0))
+    backend = ann.create(args.ann, args.ann_nlist, args.ann_nprobe, args.eval_tile, args.seed)
+    start_time = time.time()
+    backend.build(gf, args.eval_metric)
+    build_time = time.time() - start_time
+    start_time = time.time()
+    _, rows = backend.search(qf, k)
+    search_time = time.time() - start_time
+    print("ANN {}: built in {:.1f}s, {:.3f} ms/query".format(args.ann, build_time, search_time / qf.size(0) * 1000))
+    if args.ann_recall:
+        exact = ann.ExactSearch(args.eval_tile).build(gf, args.eval_metric)
+        start_time = time.time()
+        _, exact_rows = exact.search(qf, k)
+        exact_time = time.time() - start_time
+        print("ANN {}: recall@{} {:.1%} against exact search at {:.3f} ms/query".format(
+            args.ann, k, ann.recall_at_k(rows, exact_rows), exact_time / qf.size(0) * 1000))
+
+    for start in range(0, qf.size(0), args.eval_tile):
+        end = min(start + args.eval_tile, qf.size(0))
+        accumulator.update_topk(rows[start:end], q_pids[start:end], q_camids[start:end], q_seq_types[start:end])
 
-    m, n = qf.size(0), gf.size(0)
-    distmat = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-              torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-    distmat.addmm_(1, -2, qf, gf.t())
-    distmat = distmat.numpy()
 
-    print("Computing CMC and mAP")
+def test(model, queryloader, galleryloader, query_GEI, gallery_GEI, pool, use_gpu, result_file, ranks=[1, 5, 10, 20]):
+    model.eval()
+    if args.frame_feature_store:
+        qf, q_pids, q_camids, q_seq_types = extract_composed_features(model, queryloader, 'avg', use_gpu)
+    else:
+        qf, q_pids, q_camids, q_seq_types = extract_features(model, queryloader, 'avg', use_gpu)
+    qf = torch.cat((qf, torch.from_numpy(np.asarray(query_GEI)).float()), 1)
+    #####当q_pid和q_camid相同时，可能存在seq_type不一样的情况，这点是否也要算进去?？?
 
-    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, q_seq_types, g_seq_types)
+    print("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
+
+    if args.gallery_index:
+        # the index holds fused features already
+        gf, g_pids, g_camids, g_seq_types = enroll_gallery(model, galleryloader, gallery_GEI, pool, use_gpu)
+    else:
+        if args.frame_feature_store:
+            gf, g_pids, g_camids, g_seq_types = extract_composed_features(model, galleryloader, pool, use_gpu)
+        elif args.feature_store:
+            gf, g_pids, g_camids, g_seq_types = extract_stored_features(model, galleryloader, pool, use_gpu)
+        else:
+            gf, g_pids, g_camids, g_seq_types = extract_features(model, galleryloader, pool, use_gpu)
+        gf = torch.cat((gf, torch.from_numpy(np.asarray(gallery_GEI)).float()), 1)
+    print("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
+    print("Computing distance matrix, CMC and mAP")
+
+    accumulator = RankAccumulator(g_pids, g_camids, g_seq_types, partial=args.partial_rank)
+    dtype = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args.eval_precision]
+    if args.ann:
+        ann_rank(qf, gf, q_pids, q_camids, q_seq_types, accumulator)
+    else:
+        for start, end, distmat in distance_blocks(qf, gf, args.eval_tile, args.eval_metric, dtype):
+            accumulator.update(distmat, q_pids[start:end], q_camids[start:end], q_seq_types[start:end])
+    cmc, mAP = accumulator.result()
 
     print("Results ----------")
     result_file.write("Computing CMC and mAP" + "\n" + "Results ----------" + "\n")
@@ -23,12 +23,21 @@ class ResNet50TP(nn.Module):
         self.classifier1 = nn.Linear(self.feat_dim1, num_classes)
         self.classifier = nn.Linear(self.feat_dim, num_classes)
 
+    def frame_features(self, x):
+        """Per-frame features: (n, c, h, w) frames -> (n, feat_dim).
+
+        A clip's feature is the temporal average of its frames' features, so
+        clip and tracklet features can be composed from these at inference.
+        """
+        x = self.base(x)
+        x = F.avg_pool2d(x, x.size()[2:])
+        return x.view(x.size(0), -1)
+
     def forward(self, x,g=None):
         b = x.size(0)
         t = x.size(1)
         x = x.view(b*t,x.size(2), x.size(3), x.size(4))
-        x = self.base(x)
-        x = F.avg_pool2d(x, x.size()[2:])
+        x = self.frame_features(x)
         x = x.view(b,t,-1)
         x=x.permute(0,2,1)
         f = F.avg_pool1d(x,t)
@@ -1,9 +1,31 @@
 from __future__ import absolute_import
-from collections import defaultdict
 import numpy as np
 
 import torch
 
+def _csr(keys):
+    """Group positions by key: (unique keys, indices sorted by key, group offsets, group sizes)."""
+    unique, groups, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    index = np.argsort(groups, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return unique, index, offsets, counts
+
+
+def _draw(rng, offsets, counts, groups, ranks, need):
+    """Positions into a CSR index for one draw per entry of ``groups``.
+
+    Entry (i, j) is the ranks[i, j]-th of need[i, j] draws from group groups[i, j].
+    Draws from a group are distinct when it has at least ``need`` members and
+    are made with replacement otherwise.
+    """
+    grouped = np.repeat(np.arange(len(counts)), counts)
+    shuffled = np.lexsort((rng.random_sample(len(grouped)), grouped))  # each group in random order
+    offsets, counts = offsets[groups], counts[groups]
+    first = shuffled[offsets + np.minimum(ranks, counts - 1)]
+    drawn = offsets + (rng.random_sample(groups.shape) * counts).astype(np.int64)
+    return np.where(counts >= need, first, drawn)
+
+
 # class RandomIdentitySampler(object):
 class RandomIdentitySampler(torch.utils.data.Sampler):
     """
@@ -11,30 +33,206 @@ class RandomIdentitySampler(torch.utils.data.Sampler):
     randomly sample K instances, therefore batch size is N*K.
 
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/utils/data/sampler.py.
+    The pid -> indices table is kept as CSR arrays (indices grouped by identity
+    plus group offsets) built once, and an epoch is drawn with a few numpy calls.
+
+    With ``num_replicas`` > 1 every rank draws the same identity permutation
+    (so ``seed`` is required) and takes every num_replicas-th identity from it;
+    ranks therefore never share a sample within an epoch. Identities left over
+    after an even split are skipped for that epoch.
 
     Args:
         data_source (Dataset): dataset to sample from.
         num_instances (int): number of instances per identity.
+        seed (int): base seed, epoch e is drawn with seed + e (default: global numpy RNG).
+        num_replicas (int): number of distributed ranks.
+        rank (int): rank of this process.
     """
-    def __init__(self, data_source, num_instances=4):
+    def __init__(self, data_source, num_instances=4, seed=None, num_replicas=1, rank=0):
+        assert num_replicas == 1 or seed is not None, "Error: sharding across ranks needs a shared seed"
+        assert 0 <= rank < num_replicas, "Error: rank {} out of range for {} replicas".format(rank, num_replicas)
         self.data_source = data_source
         self.num_instances = num_instances
-        self.index_dic = defaultdict(list)
-        for index, (_, pid, _,_) in enumerate(data_source):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        pids = np.asarray([pid for _, pid, _, _ in data_source])
+        self.pids, self.index, self.offsets, self.counts = _csr(pids)
         self.num_identities = len(self.pids)
+        self.num_replica_identities = self.num_identities // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _random_state(self):
+        if self.seed is None:
+            return np.random
+        return np.random.RandomState(self.seed + self.epoch)
+
+    def _identities(self, rng):
+        """This rank's share of a random identity permutation."""
+        order = rng.permutation(self.num_identities)
+        return order[self.rank:self.num_replica_identities * self.num_replicas:self.num_replicas]
+
+    def __iter__(self):
+        rng = self._random_state()
+        k = self.num_instances
+        groups = np.repeat(self._identities(rng)[:, None], k, axis=1)
+        ranks = np.broadcast_to(np.arange(k), groups.shape)
+        positions = _draw(rng, self.offsets, self.counts, groups, ranks, k)
+        return iter(self.index[positions.reshape(-1)].tolist())
+
+    def __len__(self):
+        return self.num_replica_identities * self.num_instances
+
+
+def condition_of(seq_type):
+    """Walking condition of a seq_type, e.g. 'cl' for 'cl-01'."""
+    return str(seq_type).split('-')[0]
+
+
+def parse_quota(quota):
+    """Parse a per-condition quota such as 'nm:2,bg:1,cl:1' into a dict."""
+    parsed = {}
+    for item in quota.split(','):
+        condition, count = item.split(':')
+        parsed[condition.strip()] = int(count)
+    return parsed
+
+
+class ConditionBalancedSampler(RandomIdentitySampler):
+    """
+    Randomly sample N identities, then for each identity sample K instances
+    with a fixed number per walking condition (nm / bg / cl), so that every
+    batch mixes conditions instead of being dominated by nm sequences.
+
+    A second CSR index over (identity, condition) pairs is built once next to
+    the identity index; an epoch is drawn with the same vectorized calls as
+    RandomIdentitySampler. When an identity has fewer tracklets of a condition
+    than its quota, the missing share is filled from the identity's tracklets
+    not sampled yet; a tracklet repeats only if the identity has fewer than
+    num_instances tracklets.
+
+    Args:
+        data_source (Dataset): dataset to sample from.
+        num_instances (int): number of instances per identity.
+        quota (dict or str): instances per condition, e.g. 'nm:2,bg:1,cl:1', summing
+            to num_instances (default: split evenly over the conditions in data_source).
+        seed, num_replicas, rank: see RandomIdentitySampler.
+    """
+    def __init__(self, data_source, num_instances=4, quota=None, seed=None, num_replicas=1, rank=0):
+        super(ConditionBalancedSampler, self).__init__(data_source, num_instances, seed, num_replicas, rank)
+        conditions = np.asarray([condition_of(seq_type) for _, _, _, seq_type in data_source])
+        if quota is None:
+            present = np.unique(conditions)
+            base, extra = divmod(num_instances, len(present))
+            quota = {str(condition): base + (i < extra) for i, condition in enumerate(present)}
+        elif not isinstance(quota, dict):
+            quota = parse_quota(quota)
+        assert sum(quota.values()) == num_instances, \
+            "Error: quota {} does not add up to {} instances".format(quota, num_instances)
+        self.quota = quota
+        self.conditions = sorted(quota.keys())
+
+        # (identity, condition) pairs, keyed identity-major: identity * num_conditions + condition
+        pid_index = np.searchsorted(self.pids, np.asarray([pid for _, pid, _, _ in data_source]))
+        condition_index = np.asarray([self.conditions.index(c) if c in quota else -1 for c in conditions])
+        keep = np.flatnonzero(condition_index >= 0)
+        assert len(keep) > 0, "Error: no tracklet of conditions {} in data_source".format(self.conditions)
+        pair_keys = pid_index[keep] * len(self.conditions) + condition_index[keep]
+        keys, pair_index, self.pair_offsets, self.pair_counts = _csr(pair_keys)
+        self.pair_index = keep[pair_index]
+        # pair group of every (identity, condition), -1 if the identity lacks the condition
+        self.pair_table = np.full(self.num_identities * len(self.conditions), -1, dtype=np.int64)
+        self.pair_table[keys] = np.arange(len(keys))
+        self.pair_table = self.pair_table.reshape(self.num_identities, len(self.conditions))
+
+        # the condition, rank within the condition and quota of each of the K slots
+        self.slot_conditions = np.repeat(np.arange(len(self.conditions)), [quota[c] for c in self.conditions])
+        self.slot_ranks = np.concatenate([np.arange(quota[c]) for c in self.conditions])
+        self.slot_need = np.asarray([quota[c] for c in self.conditions])[self.slot_conditions]
+
+    def __iter__(self):
+        rng = self._random_state()
+        order = self._identities(rng)
+        pair_groups = self.pair_table[order][:, self.slot_conditions]
+        groups = np.maximum(pair_groups, 0)
+        ranks = np.broadcast_to(self.slot_ranks, pair_groups.shape)
+        # a condition fills its slots with distinct tracklets while it has any left
+        direct = (pair_groups >= 0) & (ranks < self.pair_counts[groups])
+        positions = _draw(rng, self.pair_offsets, self.pair_counts, groups, ranks, np.zeros_like(ranks))
+        sampled = self.pair_index[positions]
+        if not direct.all():
+            sampled = np.where(direct, sampled, self._fallback(rng, order, sampled, direct))
+        return iter(sampled.reshape(-1).tolist())
+
+    def _fallback(self, rng, order, sampled, direct):
+        """Fill the slots not covered by a condition from the identity's tracklets not sampled yet.
+
+        Each identity's tracklets are shuffled and the free ones taken in that
+        order; only an identity with fewer than num_instances tracklets repeats
+        some, drawn at random.
+        """
+        taken = np.zeros(len(self.data_source), dtype=bool)
+        taken[sampled[direct]] = True
+        grouped = np.repeat(np.arange(len(self.counts)), self.counts)
+        shuffled = np.lexsort((rng.random_sample(len(grouped)), grouped))  # each identity in random order
+        free = np.invert(taken[self.index[shuffled]])
+        # free_at[offsets[g] + r]: position of the r-th free tracklet of identity g
+        free_before = np.cumsum(free) - free
+        free_rank = free_before - free_before[self.offsets][grouped]
+        free_at = np.zeros(len(grouped), dtype=np.int64)
+        free_at[(self.offsets[grouped] + free_rank)[free]] = shuffled[free]
+        num_free = np.add.reduceat(free, self.offsets)
+
+        offsets, counts, num_free = self.offsets[order][:, None], self.counts[order][:, None], num_free[order][:, None]
+        fallback_rank = np.cumsum(np.invert(direct), axis=1) - 1
+        first_free = free_at[offsets + np.minimum(fallback_rank, np.maximum(num_free - 1, 0))]
+        drawn = offsets + (rng.random_sample(direct.shape) * counts).astype(np.int64)
+        return self.index[np.where(fallback_rank < num_free, first_free, drawn)]
+
+
+def dense_clip_count(num_frames, seq_len):
+    """Number of clips VideoDataset's 'dense' sampling cuts a tracklet into."""
+    return max(1, -(-num_frames // seq_len))
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch tracklets that 'dense' sampling cuts into the same number of clips.
+
+    Clip counts are computed from the tracklet metadata, no frame is read.
+    Tracklets are bucketed by clip count and every batch is taken from a single
+    bucket, so the clip tensors of a batch have one shape. The order is fixed
+    (by clip count, then dataset order), so iterating twice gives the same batches;
+    extract_features relies on it to put features back into dataset order.
+
+    Args:
+        data_source (Dataset): tracklets to batch.
+        seq_len (int): frames per clip.
+        batch_size (int): number of tracklets per batch.
+        max_clips (int): if set, a batch holds as many tracklets as fit in
+            max_clips clips (at least one) instead of batch_size.
+    """
+    def __init__(self, data_source, seq_len, batch_size=1, max_clips=None):
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.max_clips = max_clips
+        self.clip_counts = np.asarray([dense_clip_count(len(img_paths), seq_len)
+                                       for img_paths, _, _, _ in data_source], dtype=np.int64)
+        order = np.argsort(self.clip_counts, kind='stable')
+        counts, starts = np.unique(self.clip_counts[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.batches = []
+        for count, start, end in zip(counts, starts, ends):
+            size = max(1, max_clips // count) if max_clips else batch_size
+            for batch_start in range(start, end, size):
+                self.batches.append(order[batch_start:min(batch_start + size, end)].tolist())
 
     def __iter__(self):
-        indices = torch.randperm(self.num_identities)
-        ret = []
-        for i in indices:
-            pid = self.pids[i]
-            t = self.index_dic[pid]
-            replace = False if len(t) >= self.num_instances else True
-            t = np.random.choice(t, size=self.num_instances, replace=replace)
-            ret.extend(t)
-        return iter(ret)
+        return iter(self.batches)
 
     def __len__(self):
-        return self.num_identities * self.num_instances
+        return len(self.batches)
@@ -4,6 +4,8 @@ from torchvision.transforms import *
 from PIL import Image
 import random
 import numpy as np
+import torch
+from torch.nn import functional as F
 
 class Random2DTranslation(object):
     """
@@ -39,5 +41,138 @@ class Random2DTranslation(object):
         croped_img = resized_img.crop((x1, y1, x1 + self.width, y1 + self.height))
         return croped_img
 
+# PIL filters with a uint8 F.interpolate counterpart; nearest has none (torch and PIL
+# pick different source pixels), so it and any other filter are resized with PIL
+_interpolation_modes = {Image.BILINEAR: 'bilinear', Image.BICUBIC: 'bicubic'}
+
+
+def _pil_resize_clip(imgs, height, width, interpolation):
+    clip = np.empty((len(imgs), height, width, 3), dtype=np.uint8)
+    for t, img in enumerate(imgs):
+        img = img if isinstance(img, Image.Image) else Image.fromarray(img)
+        clip[t] = np.asarray(img.resize((width, height), interpolation))
+    return clip
+
+
+def resize_clip(imgs, height, width, interpolation=Image.BILINEAR):
+    """Resize the frames of a clip to (height, width) with one vectorized call.
+
+    Frames (PIL Images or uint8 arrays) of one size are stacked and resized
+    together by an antialiased F.interpolate on uint8. For bilinear and bicubic
+    this follows PIL's filters but is not bit-identical: upsampled pixels may
+    differ by 1-2 grey levels through rounding. Frames already at the target
+    size, e.g. from a FrameCache or FrameStore kept at that size, are only
+    stacked. A uint8 (T, H, W, 3) array, e.g. frames sliced from a FrameStore,
+    is used as it is. Clips whose frames differ in size, and filters other
+    than bilinear and bicubic, are resized frame by frame with PIL.
+
+    Returns:
+        numpy.ndarray: uint8 array of shape (T, height, width, 3).
+    """
+    if isinstance(imgs, np.ndarray):
+        frames = [imgs]
+    else:
+        frames = [np.asarray(img) for img in imgs]
+    if len(set(frame.shape for frame in frames)) > 1:
+        return _pil_resize_clip(imgs, height, width, interpolation)
+    clip = imgs if isinstance(imgs, np.ndarray) else np.stack(frames)
+    if clip.shape[1:3] == (height, width):
+        return clip
+    if interpolation not in _interpolation_modes:
+        return _pil_resize_clip(clip, height, width, interpolation)
+    x = torch.from_numpy(clip).permute(0, 3, 1, 2)  # uint8, channels_last: the fast CPU kernels
+    x = F.interpolate(x, size=(height, width), mode=_interpolation_modes[interpolation],
+                      align_corners=False, antialias=True)
+    return x.permute(0, 2, 3, 1).numpy()
+
+
+class ClipResize(object):
+    """Resize every frame of a clip into one uint8 (T, H, W, C) array, see resize_clip.
+
+    Args:
+        height (int): target height.
+        width (int): target width.
+    """
+    def __init__(self, height, width, interpolation=Image.BILINEAR):
+        self.height = height
+        self.width = width
+        self.interpolation = interpolation
+
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (list of PIL Image or uint8 (T, H, W, 3) array): frames of a clip.
+
+        Returns:
+            numpy.ndarray: uint8 array of shape (T, height, width, 3).
+        """
+        return resize_clip(imgs, self.height, self.width, self.interpolation)
+
+
+class ClipRandom2DTranslation(Random2DTranslation):
+    """Random2DTranslation with one draw per clip: all frames get the same crop.
+
+    The clip is resized with a single resize_clip call and then cropped as a
+    whole. When the frames already come at the 1.125x size (the training
+    FrameCache and FrameStore keep them at that size) the crop needs no resize.
+    """
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (list of PIL Image or uint8 (T, H, W, 3) array): frames of a clip.
+
+        Returns:
+            numpy.ndarray: uint8 array of shape (T, height, width, 3).
+        """
+        if random.random() < self.p:
+            return resize_clip(imgs, self.height, self.width, self.interpolation)
+        new_width, new_height = int(round(self.width * 1.125)), int(round(self.height * 1.125))
+        x_maxrange = new_width - self.width
+        y_maxrange = new_height - self.height
+        x1 = int(round(random.uniform(0, x_maxrange)))
+        y1 = int(round(random.uniform(0, y_maxrange)))
+        resized_clip = resize_clip(imgs, new_height, new_width, self.interpolation)
+        return resized_clip[:, y1:y1 + self.height, x1:x1 + self.width]
+
+
+class ClipRandomHorizontalFlip(object):
+    """Horizontally flip a whole (T, H, W, C) clip with probability p."""
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, clip):
+        if random.random() < self.p:
+            return clip[:, :, ::-1]
+        return clip
+
+
+class ClipToTensor(object):
+    """Convert a uint8 (T, H, W, C) clip to a uint8 (T, C, H, W) tensor.
+
+    Values stay in [0, 255]; scaling and normalization are done on whole
+    batches by BatchNormalize.
+    """
+    def __call__(self, clip):
+        return torch.from_numpy(np.ascontiguousarray(clip.transpose(0, 3, 1, 2)))
+
+
+class BatchNormalize(object):
+    """ToTensor scaling and Normalize for a whole uint8 batch of shape (..., C, H, W).
+
+    Args:
+        mean (sequence): per-channel means.
+        std (sequence): per-channel standard deviations.
+    """
+    def __init__(self, mean, std):
+        std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        self.scale = 1. / (255. * std)
+        self.shift = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1) / std
+
+    def __call__(self, imgs):
+        if imgs.dtype != torch.uint8:
+            return imgs  # already normalized by a per-frame transform
+        scale, shift = self.scale.to(imgs.device), self.shift.to(imgs.device)
+        return imgs.float().mul_(scale).sub_(shift)
+
 if __name__ == '__main__':
     pass
@@ -4,6 +4,7 @@ import sys
 import errno
 import shutil
 import json
+import hashlib
 import os.path as osp
 
 import torch
@@ -16,6 +17,11 @@ def mkdir_if_missing(directory):
             if e.errno != errno.EEXIST:
                 raise
 
+def tracklet_id(img_paths):
+    """Stable identifier of a tracklet, derived from its frame file names."""
+    names = '\n'.join(osp.basename(img_path) for img_path in img_paths)
+    return hashlib.sha1(names.encode('utf-8')).hexdigest()
+
 class AverageMeter(object):
     """Computes and stores the average and current value.
        
@@ -1,115 +1,249 @@
 from __future__ import print_function, absolute_import
 import os
+import time
+import multiprocessing as mp
 from PIL import Image
 import numpy as np
 
 import torch
-from torch.utils.data import Dataset
-import random
-
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    while not got_img:
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from utils import tracklet_id
+import frame_sampling
+
+def read_image(img_path, max_retries=3, backoff=0.1):
+    """Read an image, retrying with exponential backoff.
+    This can avoid IOError incurred by heavy IO process, while a missing or
+    corrupt file raises IOError after ``max_retries`` retries instead of
+    blocking the caller forever."""
+    for attempt in range(max_retries + 1):
+        try:
+            return Image.open(img_path).convert('RGB')
+        except IOError:
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * (2 ** attempt))
+
+
+class ImageReader(object):
+    """read_image with failure accounting, shared by all DataLoader workers.
+
+    A path that still fails after the retries is quarantined: the process
+    remembers it, appends it to ``quarantine_path`` and never retries it again.
+    Failed frames are replaced according to ``fallback`` by VideoDataset.
+    Counters live in shared memory so the main process can report them.
+
+    Args:
+        max_retries (int): retries per read before giving up.
+        backoff (float): delay before the first retry in seconds, doubled on every retry.
+        fallback (str): 'repeat' a neighbouring frame of the clip, 'drop' the frame,
+            or 'raise' an IOError.
+        quarantine_path (str): file collecting quarantined paths (default: none).
+    """
+    fallbacks = ['repeat', 'drop', 'raise']
+
+    def __init__(self, max_retries=3, backoff=0.1, fallback='repeat', quarantine_path=None):
+        if fallback not in self.fallbacks:
+            raise KeyError("Unknown fallback: {}. Expected one of {}".format(fallback, self.fallbacks))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.fallback = fallback
+        self.quarantine_path = quarantine_path
+        self.quarantine = set()
+        self.num_failures = mp.Value('l', 0)
+        self.num_fallbacks = mp.Value('l', 0)
+
+    def __call__(self, img_path):
+        """Returns the image, or None when it can not be read."""
+        if img_path in self.quarantine:
+            return None
         try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
+            return read_image(img_path, self.max_retries, self.backoff)
         except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
             pass
-    return img
+        print("IOError incurred when reading '{}' after {} retries, quarantined".format(img_path, self.max_retries))
+        self.quarantine.add(img_path)
+        with self.num_failures.get_lock():
+            self.num_failures.value += 1
+        if self.quarantine_path is not None:
+            with open(self.quarantine_path, 'a') as f:
+                f.write(img_path + '\n')
+        if self.fallback == 'raise':
+            raise IOError("Can't read image: {}".format(img_path))
+        return None
+
+    def count_fallback(self, n=1):
+        with self.num_fallbacks.get_lock():
+            self.num_fallbacks.value += n
+
+    def summary(self):
+        return "{} unreadable frames quarantined, {} frames replaced by '{}' fallback".format(
+            self.num_failures.value, self.num_fallbacks.value, self.fallback)
+
+
+def dense_collate_fn(batch):
+    """Collate tracklets sampled with sample='dense', which have different clip counts.
+
+    Clips of all tracklets in the batch are concatenated along the first dimension.
+
+    Returns:
+        clips (torch.Tensor): (total_clips, seq_len, channel, height, width).
+        num_clips (torch.LongTensor): number of clips of each tracklet.
+        pids, camids (torch.LongTensor), seq_types (list).
+    """
+    clips, pids, camids, seq_types = zip(*batch)
+    num_clips = torch.LongTensor([c.size(0) for c in clips])
+    return torch.cat(clips, dim=0), num_clips, torch.LongTensor(pids), torch.LongTensor(camids), list(seq_types)
 
 
 class VideoDataset(Dataset):
     """Video Person ReID Dataset.
     Note batch data has shape (batch, seq_len, channel, height, width).
+
+    If ``gei`` is given (an array or GEIIndex with one row per tracklet, may be
+    memory-mapped), each sample also carries its tracklet's energy image feature
+    as a last element. If ``frame_store`` (a frame_store.FrameStore) is given,
+    frames are sliced from its packed array instead of being decoded from files.
+    ``reader`` (an ImageReader) decides how unreadable frame files are handled.
+    If ``frame_cache`` (a frame_cache.FrameCache) is given, decoded frames are
+    looked up there before reading the file. ``stride`` is the frame step of
+    sample='strided'. ``clip_transform`` (see transforms.Clip*), if given, replaces
+    ``transform``: it maps the list of PIL frames of a clip to one tensor at
+    once, e.g. a uint8 (seq_len, c, h, w) clip normalized later per batch.
     """
-    sample_methods = ['evenly', 'random', 'all']
+    sample_methods = sorted(frame_sampling.methods)
 
-    def __init__(self, dataset, seq_len=15, sample='evenly', transform=None):
+    def __init__(self, dataset, seq_len=15, sample='evenly', transform=None, gei=None, frame_store=None,
+                 reader=None, frame_cache=None, stride=2, clip_transform=None):
+        if sample not in self.sample_methods:
+            raise KeyError("Unknown sample method: {}. Expected one of {}".format(sample, self.sample_methods))
         self.dataset = dataset
         self.seq_len = seq_len
         self.sample = sample
+        self.stride = stride
+        self.clip_transform = clip_transform
         self.transform = transform
+        self.gei = gei
+        self.frame_store = frame_store
+        self.reader = reader if reader is not None else ImageReader()
+        self.frame_cache = frame_cache
+        if frame_store is not None:
+            self.keys = [tracklet_id(img_paths) for img_paths, _, _, _ in dataset]
+            missing = [key for key in self.keys if key not in frame_store]
+            assert len(missing) == 0, "Error: {} tracklets are not in the frame store".format(len(missing))
+
+    def _read_frame(self, index, img_paths, frame_index):
+        if self.frame_store is not None:
+            return Image.fromarray(self.frame_store.tracklet(self.keys[index])[frame_index])
+        if self.frame_cache is not None:
+            return self.frame_cache.get(img_paths[frame_index], self.reader)
+        return self.reader(img_paths[frame_index])
+
+    def _read_clip(self, index, img_paths, indices):
+        """Read and transform the frames ``indices`` of a tracklet into a (seq_len, c, h, w) tensor."""
+        if self.frame_store is not None and self.clip_transform is not None:
+            # one gather from the packed array, no per-frame PIL images
+            return self.clip_transform(self.frame_store.tracklet(self.keys[index])[np.asarray(indices)])
+        imgs = [self._read_frame(index, img_paths, int(i)) for i in indices]
+        read = [i for i, img in enumerate(imgs) if img is not None]
+        if len(read) < len(imgs):
+            if not read:
+                # borrow any readable frame of the tracklet
+                for i in range(len(img_paths)):
+                    imgs[0] = self._read_frame(index, img_paths, i)
+                    if imgs[0] is not None:
+                        read = [0]
+                        break
+                else:
+                    raise IOError("Can't read any frame of the tracklet of '{}'".format(img_paths[0]))
+            self.reader.count_fallback(len(imgs) - len(read))
+            if self.reader.fallback == 'repeat':
+                # take the nearest readable frame of the clip
+                read = np.asarray(read)
+                imgs = [imgs[read[np.abs(read - i).argmin()]] for i in range(len(imgs))]
+            else:
+                # drop, then cycle the remaining frames to keep seq_len frames
+                kept = [imgs[i] for i in read]
+                imgs = [kept[i % len(kept)] for i in range(len(imgs))]
+        if self.clip_transform is not None:
+            return self.clip_transform(imgs)
+        clip = []
+        for img in imgs:
+            if self.transform is not None:
+                img = self.transform(img)
+            img = img.unsqueeze(0)
+            clip.append(img)
+        return torch.cat(clip, dim=0)
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
-        img_paths, pid, camid,seq_type = self.dataset[index]
-        num = len(img_paths)
-        if self.sample == 'random':
-            """
-            Randomly sample seq_len consecutive frames from num frames,
-            if num is smaller than seq_len, then replicate items.
-            This sampling strategy is used in training phase.
-            """
-            frame_indices = range(num)
-            rand_end = max(0, len(frame_indices) - self.seq_len - 1)
-            begin_index = random.randint(0, rand_end)
-            end_index = min(begin_index + self.seq_len, len(frame_indices))
-
-            indices = frame_indices[begin_index:end_index]
-
-            for index in indices:
-                if len(indices) >= self.seq_len:
-                    break
-                indices.append(index)
-            indices=np.array(indices)
-            imgs = []
-            for index in indices:
-                index=int(index)
-                img_path = img_paths[index]
-                img = read_image(img_path)
-                if self.transform is not None:
-                    img = self.transform(img)
-                img = img.unsqueeze(0)
-                imgs.append(img)
-            imgs = torch.cat(imgs, dim=0)
-            #imgs=imgs.permute(1,0,2,3)
-            return imgs, pid, camid,seq_type
-
-        elif self.sample == 'dense':
-            """
-            Sample all frames in a video into a list of clips, each clip contains seq_len frames, batch_size needs to be set to 1.
-            This sampling strategy is used in test phase.
-            """
-            cur_index=0
-            frame_indices = list(range(num))
-            indices_list=[]
-            while num-cur_index > self.seq_len:
-                indices_list.append(frame_indices[cur_index:cur_index+self.seq_len])
-                cur_index+=self.seq_len
-            last_seq=frame_indices[cur_index:]
-            for index in last_seq:
-                if len(last_seq) >= self.seq_len:
-                    break
-                last_seq.append(index)
-            indices_list.append(last_seq)
-            imgs_list=[]
-            for indices in indices_list:
-                imgs = []
-                for index in indices:
-                    index=int(index)
-                    img_path = img_paths[index]
-                    img = read_image(img_path)
-                    if self.transform is not None:
-                        img = self.transform(img)
-                    img = img.unsqueeze(0)
-                    imgs.append(img)
-                imgs = torch.cat(imgs, dim=0)
-                #imgs=imgs.permute(1,0,2,3)
-                imgs_list.append(imgs)
-            imgs_array = torch.stack(imgs_list)
-            return imgs_array, pid, camid,seq_type
-
+        sample = self._get_frames(index)
+        if self.gei is not None:
+            sample = sample + (np.array(self.gei[index], dtype=np.float32),)
+        return sample
+
+    def _get_frames(self, tracklet_index):
+        """
+        Frames are chosen by frame_sampling.frame_indices. 'random' (= 'consecutive'),
+        'strided' and 'segment' are randomized and meant for training; 'evenly',
+        'dense' and 'all' are deterministic. 'dense' cuts the tracklet into a
+        (num_clips, seq_len, c, h, w) stack of clips, see dense_collate_fn; 'all'
+        returns every frame as a single clip of variable length.
+        """
+        img_paths, pid, camid,seq_type = self.dataset[tracklet_index]
+        indices = frame_sampling.frame_indices(self.sample, len(img_paths), self.seq_len, stride=self.stride)
+        if indices.ndim == 2:
+            imgs = torch.stack([self._read_clip(tracklet_index, img_paths, clip) for clip in indices])
         else:
-            raise KeyError("Unknown sample method: {}. Expected one of {}".format(self.sample, self.sample_methods))
-
-
-
+            imgs = self._read_clip(tracklet_index, img_paths, indices)
+        return imgs, pid, camid,seq_type
 
 
+class VideoChunkDataset(IterableDataset):
+    """Stream the tracklets of a VideoDataset as fixed-size chunks.
 
+    Yields (chunk, position, pid, camid, seq_type), where position is the
+    tracklet's index in ``indices`` and chunk holds at most ``chunk_size``
+    frames: (k, c, h, w) frames for sample='all', or (k, seq_len, c, h, w)
+    clips for sample='dense'. Only one chunk is decoded at a time, so worker
+    memory does not grow with the tracklet length. Tracklets are split among
+    DataLoader workers, chunks of a tracklet come in order. Load with
+    batch_size=None.
 
+    Args:
+        video_dataset (VideoDataset): frames source, sample must be 'all' or 'dense'.
+        chunk_size (int): number of frames per chunk.
+        indices (list): tracklets to stream (default: all).
+    """
+    def __init__(self, video_dataset, chunk_size=64, indices=None):
+        assert video_dataset.sample in ('all', 'dense'), \
+            "Error: streaming needs sample 'all' or 'dense', but got {}".format(video_dataset.sample)
+        self.video = video_dataset
+        self.dataset = video_dataset.dataset
+        self.sample = video_dataset.sample
+        self.seq_len = video_dataset.seq_len
+        self.chunk_size = chunk_size
+        self.indices = list(range(len(self.dataset))) if indices is None else list(indices)
+        self.num_tracklets = len(self.indices)
+
+    def __iter__(self):
+        positions = range(self.num_tracklets)
+        worker = get_worker_info()
+        if worker is not None:
+            positions = positions[worker.id::worker.num_workers]
+        for position in positions:
+            index = self.indices[position]
+            img_paths, pid, camid, seq_type = self.dataset[index]
+            indices = frame_sampling.frame_indices(self.sample, len(img_paths), self.seq_len)
+            if indices.ndim == 2:
+                step = max(1, self.chunk_size // self.seq_len)
+                for start in range(0, len(indices), step):
+                    chunk = torch.stack([self.video._read_clip(index, img_paths, clip)
+                                         for clip in indices[start:start + step]])
+                    yield chunk, position, int(pid), int(camid), seq_type
+            else:
+                for start in range(0, len(indices), self.chunk_size):
+                    chunk = self.video._read_clip(index, img_paths, indices[start:start + self.chunk_size])
+                    yield chunk, position, int(pid), int(camid), seq_type